@@ -1,10 +1,3 @@
-from aiostun.client import Client
-from aiostun.nat import NAT
-from aiostun.stun import Codec
-from aiostun.stun import Message
-
-from aiostun.attribute import AttrChangeRequest
-
 from aiostun.constants import FAMILY_IP4 as IP4
 from aiostun.constants import FAMILY_IP6 as IP6
 
@@ -12,10 +5,70 @@ from aiostun.constants import IPPROTO_UDP as UDP
 from aiostun.constants import IPPROTO_TCP as TCP
 from aiostun.constants import IPPROTO_TLS as TLS
 
+from aiostun.constants import QUEUE_DROP_OLDEST
+from aiostun.constants import QUEUE_DROP_NEWEST
+from aiostun.constants import QUEUE_PAUSE_READING
+
 from aiostun.constants import CLASS_REQUEST
 from aiostun.constants import CLASS_INDICATION
 
 from aiostun.constants import METHOD_BINDING
 from aiostun.constants import METHOD_SHARED_SECRET
 from aiostun.constants import METHOD_ALLOCATE
-from aiostun.constants import METHOD_REFRESH
\ No newline at end of file
+from aiostun.constants import METHOD_REFRESH
+
+# submodules and classes are imported on first access, to keep
+# "import aiostun" cheap for short-lived processes
+_LAZY_ATTRS = {
+    "Client": "aiostun.client",
+    "NAT": "aiostun.nat",
+    "Server": "aiostun.server",
+    "SyncClient": "aiostun.sync",
+    "SyncNAT": "aiostun.sync",
+    "RateLimiter": "aiostun.ratelimit",
+    "ServerRegistry": "aiostun.health",
+    "Codec": "aiostun.stun",
+    "Message": "aiostun.stun",
+    "Metrics": "aiostun.metrics",
+    "Registry": "aiostun.metrics",
+    "AttrChangeRequest": "aiostun.attribute",
+}
+
+_LAZY_MODULES = [
+    "attribute",
+    "bulk",
+    "client",
+    "demux",
+    "discovery",
+    "health",
+    "metrics",
+    "nat",
+    "pcap",
+    "ratelimit",
+    "server",
+    "simulator",
+    "stun",
+    "sync",
+    "tracing",
+]
+
+def __getattr__(name):
+    """import submodules and classes on first access"""
+    import sys
+    if name in _LAZY_ATTRS:
+        modname = _LAZY_ATTRS[name]
+    elif name in _LAZY_MODULES:
+        modname = "aiostun.%s" % name
+    else:
+        raise AttributeError("module 'aiostun' has no attribute '%s'" % name)
+
+    __import__(modname)
+    value = sys.modules[modname]
+    if name in _LAZY_ATTRS:
+        value = getattr(value, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    """list lazy attributes too"""
+    return sorted(list(globals()) + list(_LAZY_ATTRS) + _LAZY_MODULES)
@@ -1,8 +1,95 @@
 import struct
-import ipaddress
+import threading
+import collections
 
 from aiostun import constants
 
+# decoded address, shared between the attributes decoded from the same bytes
+Address = collections.namedtuple("Address", ["family", "ip", "port"])
+
+class AddrCache:
+    def __init__(self, maxsize=1024):
+        """bounded lru cache of decoded addresses, keyed by the raw attribute value, 0 disables it
+
+        the cache is shared by the threads of the process, the sync client
+        loop or the bulk decoder for instance, so it is guarded by a lock
+        """
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """cached address or None"""
+        with self._lock:
+            addr = self._entries.get(key)
+            if addr is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return addr
+
+    def store(self, key, addr):
+        """add an address, the least recently used one is evicted when full"""
+        if self.maxsize:
+            with self._lock:
+                self._entries[key] = addr
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return addr
+
+    def clear(self):
+        """empty the cache and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """hits, misses, size and hit rate"""
+        with self._lock:
+            total = self.hits + self.misses
+            return { "hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                     "hit-rate": self.hits / total if total else 0.0 }
+
+# used by the decoders of the address attributes
+addr_cache = AddrCache()
+
+def ip_to_str(family, packed):
+    """format a packed ip address, ipaddress is only imported when needed"""
+    import ipaddress
+    if family == constants.FAMILY_IP4:
+        return "%s" % ipaddress.IPv4Address(packed)
+    return "%s" % ipaddress.IPv6Address(packed)
+
+def ip_to_bytes(ip):
+    """pack an ip address string"""
+    import ipaddress
+    return ipaddress.ip_address(ip).packed
+
+def unmap_ip(ip):
+    """ipv4 address of an ipv4-mapped ipv6 address (::ffff:a.b.c.d), the ip itself otherwise"""
+    if ip[:7].lower() == "::ffff:" and "." in ip:
+        return ip[7:]
+    return ip
+
+def addr_family(value):
+    """family of an address attribute value, ValueError if malformed"""
+    if len(value) == 8 and value[1] == constants.FAMILY_IP4:
+        return constants.FAMILY_IP4
+    if len(value) == 20 and value[1] == constants.FAMILY_IP6:
+        return constants.FAMILY_IP6
+    raise ValueError("Bad address attribute")
+
+def family_code(name):
+    """protocol family from its name"""
+    for family, family_name in constants.FAMILY_NAMES.items():
+        if family_name == name:
+            return family
+    return None
+
 class Attribute:
     def __init__(self, attr_type):
         """init"""
@@ -51,22 +138,34 @@ class AttributeAddr(Attribute):
         return ret
 
     def decode(self, value):
-        """decode the attribute"""
-        # read family protocol, ipv4 (1) or ipv6 (2)
-        (family,) = struct.unpack("!B", value[1:2])
-        if family > 0x02 and family < 0x01:
-            return False
-
-        # decode port and ip
-        (port,) = struct.unpack("!H", value[2:4])
-        if family == 0x01:
-            ip = "%s" % ipaddress.IPv4Address(value[4:])
-        if family == 0x02:
-            ip = "%s" % ipaddress.IPv6Address(value[4:])
-
+        """decode the attribute, the same bytes are decoded once"""
+        key = bytes(value)
+        addr = addr_cache.lookup(key)
+        if addr is None:
+            # read family protocol, ipv4 (1) or ipv6 (2)
+            family = addr_family(value)
+
+            # decode port and ip
+            (port,) = struct.unpack("!H", value[2:4])
+            ip = ip_to_str(family, value[4:])
+            addr = addr_cache.store(key, Address(constants.FAMILY_NAMES[family], ip, port))
+
+        self.address = addr
+        self.params["family"] = addr.family
+        self.params["port"] = addr.port
+        self.params["ip"] = addr.ip
+
+    def set_address(self, family, ip, port):
+        """set the address to encode"""
         self.params["family"] = constants.FAMILY_NAMES[family]
         self.params["port"] = port
         self.params["ip"] = ip
+        return self
+
+    def encode(self):
+        """to bytes"""
+        family = family_code(self.params["family"])
+        return struct.pack("!BBH", 0, family, self.params["port"]) + ip_to_bytes(self.params["ip"])
 
 class AttributeStr(Attribute):
     def __init__(self, attr_type, attr_value):
@@ -92,11 +191,23 @@ class AttrXorMappedAddr(Attribute):
         return ret
 
     def decode(self, value, tid):
-        """decode the attribute"""
+        """decode the attribute, cached for ipv4 where the transaction id is not part of the key"""
+        cache_key = ("xor", bytes(value)) if len(value) == 8 else None
+        addr = None if cache_key is None else addr_cache.lookup(cache_key)
+        if addr is None:
+            addr = self.decode_addr(value, tid)
+            if cache_key is not None:
+                addr_cache.store(cache_key, addr)
+
+        self.address = addr
+        self.params["family"] = addr.family
+        self.params["port"] = addr.port
+        self.params["ip"] = addr.ip
+
+    def decode_addr(self, value, tid):
+        """decode the xored address"""
         # read family protocol, ipv4 (1) or ipv6 (2)
-        (family,) = struct.unpack("!B", value[1:2])
-        if family > 0x02 and family < 0x01:
-            return False
+        family = addr_family(value)
 
         # decode port
         (port_xor,) = struct.unpack("!H", value[2:4])
@@ -111,14 +222,24 @@ class AttrXorMappedAddr(Attribute):
 
         # decode ip
         host = bytes(a ^ b for a, b in zip(value[4:], key))
-        if family == 0x01:
-            ip = "%s" % ipaddress.IPv4Address(host)
-        if family == 0x02:
-            ip = "%s" % ipaddress.IPv6Address(host)
+        ip = ip_to_str(family, host)
+        return Address(constants.FAMILY_NAMES[family], ip, port)
 
+    def set_address(self, family, ip, port, tid):
+        """set the address to encode, the transaction id is part of the key for ipv6"""
         self.params["family"] = constants.FAMILY_NAMES[family]
         self.params["port"] = port
         self.params["ip"] = ip
+        self.transaction_id = tid
+        return self
+
+    def encode(self):
+        """to bytes"""
+        family = family_code(self.params["family"])
+        port = self.params["port"] ^ (constants.MAGIC_COOKIE >> 16)
+        key = struct.pack("!L12s", constants.MAGIC_COOKIE, self.transaction_id)
+        host = bytes(a ^ b for a, b in zip(ip_to_bytes(self.params["ip"]), key))
+        return struct.pack("!BBH", 0, family, port) + host
 
 # basic address (ip/port) attributes
 class AttrMappedAddr(AttributeAddr):
@@ -136,6 +257,9 @@ class AttrSourceAddress(AttributeAddr):
 class AttrChangedAddress(AttributeAddr):
     def __init__(self):
         Attribute.__init__(self, attr_type=constants.ATTR_CHANGED_ADDRESS)
+class AttrAlternateServer(AttributeAddr):
+    def __init__(self):
+        Attribute.__init__(self, attr_type=constants.ATTR_ALTERNATE_SERVER)
 
 class AttrChangeRequest(Attribute):
     def __init__(self, changeIp=False, changePort=False):
@@ -169,11 +293,24 @@ class AttrErrorCode(Attribute):
         return ret
 
     def decode(self, value):
+        if len(value) < 4:
+            raise ValueError("Bad error code attribute")
         err_code = value[2]*100 + value[3]
         err_phrase = value[4:].decode()
         self.params["code"] = err_code
         self.params["phrase"] = err_phrase
 
+    def set_error(self, code, phrase=""):
+        """set the error to encode"""
+        self.params["code"] = code
+        self.params["phrase"] = phrase
+        return self
+
+    def encode(self):
+        """to bytes"""
+        code = self.params["code"]
+        return struct.pack("!HBB", 0, code // 100, code % 100) + self.params["phrase"].encode()
+
 
 # https://www.rfc-editor.org/rfc/rfc3489#section-11.2.8
 class AttrIntegrity(AttributeStr):
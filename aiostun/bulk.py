@@ -0,0 +1,168 @@
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from aiostun import constants
+from aiostun.attribute import ip_to_str
+
+# fixed part of the stun header, https://www.rfc-editor.org/rfc/rfc5389#section-6
+def header_dtype():
+    """structured dtype of the stun header"""
+    return np.dtype([
+        ("type", ">u2"),
+        ("length", ">u2"),
+        ("cookie", ">u4"),
+        ("transaction_id", "V12"),
+    ])
+
+# one row per decoded message, the ip is stored on 16 bytes
+# ipv4 addresses are ipv4-mapped (::ffff:a.b.c.d)
+def result_dtype():
+    """structured dtype of the bulk decoder output"""
+    return np.dtype([
+        ("offset", "<u8"),
+        ("msgclass", "u1"),
+        ("msgmethod", "<u2"),
+        ("length", "<u2"),
+        ("magic_cookie", "<u4"),
+        ("transaction_id", "V12"),
+        ("attr_type", "<u2"),
+        ("family", "u1"),
+        ("port", "<u2"),
+        ("ip", "u1", (16,)),
+    ])
+
+def split(buf):
+    """return the offsets of the messages concatenated in the buffer"""
+    offsets = []
+    pos = 0
+    end = len(buf) - constants.STUN_HEADER_SIZE
+    while pos <= end:
+        (stunlength,) = struct.unpack_from("!H", buf, pos + 2)
+        if pos + constants.STUN_HEADER_SIZE + stunlength > len(buf):
+            break
+        offsets.append(pos)
+        pos += constants.STUN_HEADER_SIZE + stunlength
+    return offsets
+
+def _u16(data, pos):
+    """read big endian 16 bits integers at the positions"""
+    return (data[pos].astype(np.uint16) << 8) | data[pos + 1]
+
+def decode(messages):
+    """decode many stun messages in columnar arrays
+
+    messages is a sequence of bytes, one per message, or a single buffer
+    with the messages concatenated one after the other. The mapped address is
+    read from the XOR-MAPPED-ADDRESS attribute or from MAPPED-ADDRESS otherwise.
+    """
+    if np is None:
+        raise RuntimeError("numpy is required by the bulk decoder")
+
+    if isinstance(messages, (bytes, bytearray, memoryview)):
+        buf = bytes(messages)
+        offsets = np.array(split(buf), dtype=np.int64)
+    else:
+        sizes = np.fromiter((len(m) for m in messages), dtype=np.int64, count=len(messages))
+        buf = b"".join(messages)
+        offsets = np.zeros(len(sizes), dtype=np.int64)
+        np.cumsum(sizes[:-1], out=offsets[1:])
+        # drop truncated messages
+        sizes_ok = sizes >= constants.STUN_HEADER_SIZE
+        data = np.frombuffer(buf, dtype=np.uint8)
+        declared = np.zeros(len(sizes), dtype=np.int64)
+        declared[sizes_ok] = _u16(data, offsets[sizes_ok] + 2)
+        offsets = offsets[sizes_ok & (declared + constants.STUN_HEADER_SIZE <= sizes)]
+
+    n = len(offsets)
+    out = np.zeros(n, dtype=result_dtype())
+    if n == 0:
+        return out
+
+    # pad the buffer so that reading an address never goes out of bounds
+    data = np.frombuffer(buf + b"\x00" * 24, dtype=np.uint8)
+
+    # decode headers
+    rows = data[offsets[:, None] + np.arange(constants.STUN_HEADER_SIZE)]
+    hdr = np.ascontiguousarray(rows).view(header_dtype()).reshape(n)
+    stuntype = hdr["type"].astype(np.uint16)
+    out["offset"] = offsets
+    out["msgclass"] = ((stuntype & 0x0010) >> 4) | ((stuntype & 0x0100) >> 7)
+    out["msgmethod"] = (stuntype & 0x000F) | ((stuntype & 0x00E0) >> 1) | ((stuntype & 0x3E00) >> 2)
+    out["length"] = hdr["length"]
+    out["magic_cookie"] = np.where(hdr["cookie"] == constants.MAGIC_COOKIE, hdr["cookie"], 0)
+    out["transaction_id"] = hdr["transaction_id"]
+
+    # walk the attributes of all messages at once, one attribute per iteration
+    ends = offsets + constants.STUN_HEADER_SIZE + hdr["length"].astype(np.int64)
+    cursor = offsets + constants.STUN_HEADER_SIZE
+    xor_pos = np.full(n, -1, dtype=np.int64)
+    mapped_pos = np.full(n, -1, dtype=np.int64)
+    active = cursor + 4 <= ends
+    while active.any():
+        idx = np.nonzero(active)[0]
+        pos = cursor[idx]
+        attr_type = _u16(data, pos)
+        attr_length = _u16(data, pos + 2).astype(np.int64)
+        fits = pos + 4 + attr_length <= ends[idx]
+
+        is_xor = fits & ((attr_type == constants.ATTR_XOR_MAPPED_ADDRESS) | (attr_type == constants.ATTR_XOR_MAPPED_ADDRESS_OPTIONAL))
+        sel = idx[is_xor & (xor_pos[idx] < 0)]
+        xor_pos[sel] = cursor[sel]
+        is_mapped = fits & (attr_type == constants.ATTR_MAPPED_ADDRESS)
+        sel = idx[is_mapped & (mapped_pos[idx] < 0)]
+        mapped_pos[sel] = cursor[sel]
+
+        # next attribute, always a multiple of 4 bytes
+        cursor[idx] = pos + 4 + ((attr_length + 3) & ~3)
+        active[idx] = fits & (cursor[idx] + 4 <= ends[idx])
+
+    use_xor = xor_pos >= 0
+    attr_pos = np.where(use_xor, xor_pos, mapped_pos)
+    found = attr_pos >= 0
+    idx = np.nonzero(found)[0]
+    pos = attr_pos[idx]
+    xor = use_xor[idx]
+
+    family = data[pos + 5]
+    port = _u16(data, pos + 6)
+    port = np.where(xor, port ^ (constants.MAGIC_COOKIE >> 16), port)
+
+    # the xor key is the magic cookie followed by the transaction id,
+    # which are also the bytes 4 to 20 of the header
+    key = data[offsets[idx][:, None] + 4 + np.arange(16)]
+    key[~xor] = 0
+    ip4 = data[(pos + 8)[:, None] + np.arange(4)] ^ key[:, :4]
+    ip6 = data[(pos + 8)[:, None] + np.arange(16)] ^ key
+
+    is_ip4 = family == constants.FAMILY_IP4
+    is_ip6 = family == constants.FAMILY_IP6
+    ip = np.zeros((len(idx), 16), dtype=np.uint8)
+    ip[is_ip4, 10:12] = 0xFF
+    ip[is_ip4, 12:] = ip4[is_ip4]
+    ip[is_ip6] = ip6[is_ip6]
+
+    # exact lengths, like aiostun.attribute.addr_family
+    attr_length = _u16(data, pos + 2)
+    valid = (is_ip4 & (attr_length == 8)) | (is_ip6 & (attr_length == 20))
+    idx = idx[valid]
+    out["attr_type"][idx] = _u16(data, pos[valid])
+    out["family"][idx] = family[valid]
+    out["port"][idx] = port[valid]
+    out["ip"][idx] = ip[valid]
+    return out
+
+def ip_strings(result):
+    """format the ip column of a decoded batch, None when no address"""
+    ret = []
+    for family, ip in zip(result["family"], result["ip"]):
+        if family == constants.FAMILY_IP4:
+            ret.append(ip_to_str(family, ip[12:].tobytes()))
+        elif family == constants.FAMILY_IP6:
+            ret.append(ip_to_str(family, ip.tobytes()))
+        else:
+            ret.append(None)
+    return ret
@@ -1,23 +1,31 @@
-import ssl
+import time
 import asyncio
+import collections
 import socket
 
 from aiostun import constants
 from aiostun import stun
 from aiostun import attribute
+from aiostun import metrics as stun_metrics
+from aiostun import tracing
 
 
 class TransportProtocol:
-    def __init__(self, client, proto):
+    def __init__(self, client, proto, metrics=None):
         """init"""
         self._client = client
         self._transport = None
         self._proto = proto
+        self._metrics = metrics
+        self._detached = False
 
     def connection_made(self, transport):
         """on connection made"""
         self._transport = transport
         self._client.send = self.send
+        # only stream transports can be paused
+        if self._proto in [constants.IPPROTO_TCP, constants.IPPROTO_TLS]:
+            self._client.transport = transport
 
     def data_received(self, data):
         """on tcp/tls data received"""
@@ -25,7 +33,7 @@ class TransportProtocol:
 
     def datagram_received(self, data, addr):
         """on udp datagram received"""
-        self._client.feed_data(data)
+        self._client.feed_datagram(data)
 
     def send(self, data, addr=None):
         """send"""
@@ -36,11 +44,18 @@ class TransportProtocol:
 
     def error_received(self, exc):
         """on error"""
-        print("error:", exc)
+        if self._metrics is not None:
+            self._metrics.inc(stun_metrics.TRANSPORT_ERRORS)
+
+    def detach(self):
+        """the client closes the transport to reconnect, the streams are not ended"""
+        self._detached = True
 
     def connection_lost(self, exc):
         """on connection lost"""
-        pass
+        if self._detached:
+            return
+        self._client.connection_lost()
 
 
 class Client:
@@ -54,18 +69,40 @@ class Client:
         local_addr=None,
         local_port=None,
         cafile=None,
+        retransmissions=0,
+        rto=0.5,
+        metrics=None,
+        tracer=None,
+        queue_size=64,
+        queue_overflow=constants.QUEUE_DROP_OLDEST,
+        demux=False,
+        max_redirects=2,
+        health=None,
+        network=None,
     ):
         """init"""
         self._host = host
         self._port = port
         self._family = family
         self._ipproto = proto
-        self._stun_codec = stun.Codec()
+        self._stun_codec = stun.Codec(metrics=metrics, tracer=tracer,
+                                      maxsize=queue_size, overflow=queue_overflow)
         self._transport = None
         self._timeout = timeout
         self._local_addr = local_addr
         self._local_port = local_port
         self._cafile = cafile
+        self._retransmissions = retransmissions
+        self._rto = rto
+        self._metrics = metrics
+        self._tracer = tracer
+        self._demux = demux
+        self._max_redirects = max_redirects
+        self._health = health
+        # creates the udp endpoints instead of the loop, a simulated host for instance
+        self._network = network
+        self._protocol = None
+        self._app_protocols = {}
 
     async def __aenter__(self):
         """aenter"""
@@ -88,18 +125,35 @@ class Client:
         if self._ipproto == constants.IPPROTO_UDP:
             if remote_addr:
                 kwargs["remote_addr"] = self._host, self._port
-            protocol = TransportProtocol(self._stun_codec, self._ipproto)
+            if self._demux:
+                # share the socket with dtls/rtp, rfc7983
+                from aiostun import demux
+                protocol = demux.DemuxProtocol(self._stun_codec, self._ipproto, self._metrics)
+                for kind, app_protocol in self._app_protocols.items():
+                    protocol.register(kind, app_protocol)
+            else:
+                protocol = TransportProtocol(self._stun_codec, self._ipproto, self._metrics)
+            self._protocol = protocol
             kwargs["protocol_factory"] = lambda: protocol
-            coro = loop.create_datagram_endpoint(**kwargs)
+            endpoints = loop if self._network is None else self._network
+            coro = endpoints.create_datagram_endpoint(**kwargs)
+
+        if self._network is not None and self._ipproto != constants.IPPROTO_UDP:
+            raise RuntimeError("Only udp is supported with a network")
 
         if self._ipproto == constants.IPPROTO_TCP:
             kwargs["host"] = self._host
             kwargs["port"] = self._port
-            protocol = TransportProtocol(self._stun_codec, self._ipproto)
+            protocol = TransportProtocol(self._stun_codec, self._ipproto, self._metrics)
+            self._protocol = protocol
             kwargs["protocol_factory"] = lambda: protocol
             coro = loop.create_connection(**kwargs)
 
+        cert_error = ()
         if self._ipproto == constants.IPPROTO_TLS:
+            # ssl is slow to import, only load it for tls
+            import ssl
+            cert_error = ssl.SSLCertVerificationError
             if self._cafile is None:
                 sslcontext = ssl.create_default_context()
                 sslcontext.check_hostname = False
@@ -112,7 +166,8 @@ class Client:
             kwargs["host"] = self._host
             kwargs["port"] = self._port
             kwargs["ssl"] = sslcontext
-            protocol = TransportProtocol(self._stun_codec, self._ipproto)
+            protocol = TransportProtocol(self._stun_codec, self._ipproto, self._metrics)
+            self._protocol = protocol
             kwargs["protocol_factory"] = lambda: protocol
             coro = loop.create_connection(**kwargs)
 
@@ -120,10 +175,18 @@ class Client:
             self._transport, _ = await asyncio.wait_for(coro, timeout=self._timeout)
         except asyncio.TimeoutError:
             raise RuntimeError("Timeout error")
-        except ssl.SSLCertVerificationError as e:
+        except cert_error as e:
             raise RuntimeError(f"SSL Cert verification error.[{e}]")
         return self
 
+    def register_protocol(self, kind, protocol):
+        """route the non stun packets of this kind (see aiostun.demux) to the protocol"""
+        if not self._demux or self._ipproto != constants.IPPROTO_UDP:
+            raise RuntimeError("Demultiplexing requires demux=True over UDP")
+        self._app_protocols[kind] = protocol
+        if self._protocol is not None:
+            self._protocol.register(kind, protocol)
+
     def close(self):
         """close transport"""
         if self._transport is not None:
@@ -136,7 +199,7 @@ class Client:
 
         sock = self._transport.get_extra_info("socket")
         if sock is None:
-            return None
+            return self._transport.get_extra_info("sockname")
 
         return sock.getsockname()
 
@@ -147,7 +210,7 @@ class Client:
 
         sock = self._transport.get_extra_info("socket")
         if sock is None:
-            return None
+            return self._transport.get_extra_info("peername")
 
         return sock.getpeername()
 
@@ -160,25 +223,218 @@ class Client:
         data = self._stun_codec.encode(req)
 
         # send it
+        self._stun_codec.add_pending(req.transaction_id)
+        if self._tracer is not None:
+            self._tracer(tracing.EVENT_SEND, req.transaction_id, time.monotonic())
         self._stun_codec.send(data=data, addr=remote_addr)
 
+        if self._metrics is not None:
+            labels = {"server": self._server_label(remote_addr)}
+            self._metrics.inc(stun_metrics.REQUESTS_SENT, labels=labels)
+            self._metrics.inc(stun_metrics.BYTES_OUT, len(data))
         return True
 
-    async def wait_for_resp(self):
-        """wait for response"""
-        if self._transport is None:
-            return None
+    def _server_label(self, remote_addr=None):
+        """server label used by the metrics"""
+        if remote_addr is None:
+            return "%s:%s" % (self._host, self._port)
+        return "%s:%s" % remote_addr[:2]
 
+    def _health_key(self, remote_addr=None):
+        """host, port, proto and family of the server for the health registry"""
+        (host, port) = (self._host, self._port) if remote_addr is None else remote_addr[:2]
+        return (host, port, self._ipproto, self._family)
+
+    async def _get_resp(self, timeout):
+        """read the next response from the queue"""
         try:
             resp = await asyncio.wait_for(
-                self._stun_codec._queue.get(), timeout=self._timeout
+                self._stun_codec.get(), timeout=timeout
             )
         except asyncio.TimeoutError:
             return None
         return resp
 
-    async def bind_request(self, use_classicstun=False, attrs=[], remote_addr=None):
-        """send bind request"""
+    async def _wait_match(self, req, timeout):
+        """wait for the response to the request, stale responses are discarded"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            resp = await self._get_resp(deadline - loop.time())
+            if resp is None:
+                return None
+
+            # If the message class is "Success Response" or "Error Response"
+            # checks that the transaction ID matches the request
+            if resp.msgclass in [constants.CLASS_SUCCESS, constants.CLASS_ERROR]:
+                if req.transaction_id != resp.transaction_id:
+                    if self._metrics is not None:
+                        self._metrics.inc(stun_metrics.RESPONSES_UNMATCHED)
+                    if self._tracer is not None:
+                        self._tracer(tracing.EVENT_UNMATCHED, req.transaction_id, time.monotonic())
+                    continue
+            return resp
+
+    def on_message(self, callback, batch=False):
+        """call back for each message received which is not a response to a pending request
+
+        the callback receives the message straight from the transport, or the list of
+        messages received during the loop iteration with batch, and None when the
+        connection is lost. Set None to go back to the queue.
+        """
+        self._stun_codec.set_on_message(callback, batch=batch)
+
+    async def messages(self):
+        """async iterator over the messages which are not responses to a pending request
+
+        there is one consumer at a time, RuntimeError if the messages are
+        already delivered to a callback or another iterator. The oldest
+        messages are dropped when the consumer is too slow.
+        """
+        if self._stun_codec._on_message is not None:
+            raise RuntimeError("Messages already consumed")
+        loop = asyncio.get_running_loop()
+        received = collections.deque(maxlen=self._stun_codec._queue.maxsize or None)
+        waiter = None
+        closed = False
+
+        def on_message(msg):
+            nonlocal closed
+            if msg is None:
+                closed = True
+            else:
+                if len(received) == received.maxlen and self._metrics is not None:
+                    self._metrics.inc(stun_metrics.QUEUE_DROPPED)
+                received.append(msg)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+
+        self.on_message(on_message)
+        try:
+            while True:
+                while received:
+                    yield received.popleft()
+                if closed:
+                    return
+                waiter = loop.create_future()
+                await waiter
+                waiter = None
+        finally:
+            self.on_message(None)
+
+    async def wait_for_resp(self):
+        """wait for response"""
+        if self._transport is None:
+            return None
+
+        resp = await self._get_resp(self._timeout)
+        if resp is None:
+            if self._metrics is not None:
+                self._metrics.inc(stun_metrics.TIMEOUTS)
+            # close the spans of the requests still waiting
+            if self._tracer is not None:
+                for transaction_id in list(self._stun_codec.pending):
+                    self._tracer(tracing.EVENT_TIMEOUT, transaction_id, time.monotonic())
+            return None
+
+        if resp.msgclass in [constants.CLASS_SUCCESS, constants.CLASS_ERROR] and self._tracer is not None:
+            self._tracer(tracing.EVENT_MATCHED, resp.transaction_id, time.monotonic())
+        return resp
+
+    async def bind_request(self, use_classicstun=False, attrs=[], remote_addr=None, record_health=True):
+        """send bind request, 300 try alternate responses are followed up to max_redirects times
+
+        over tls the 300 response is returned, the redirect is not followed
+
+        with record_health=False the outcome is not recorded in the health
+        registry, for probes which are expected to time out
+        """
+        visited = [ self._server_addr(remote_addr) ]
+        while True:
+            resp = await self._bind_once(use_classicstun, attrs, remote_addr, record_health)
+
+            # loop protection, a server is never tried twice
+            alternate = self._alternate(resp)
+            if alternate is None or alternate in visited or len(visited) > self._max_redirects:
+                return resp
+            # the certificate of the alternate server could not be checked
+            # against its bare ip, redirects are not followed over tls
+            if remote_addr is None and self._ipproto == constants.IPPROTO_TLS:
+                return resp
+            visited.append(alternate)
+            if self._metrics is not None:
+                self._metrics.inc(stun_metrics.REDIRECTS_FOLLOWED)
+
+            if remote_addr is None:
+                await self._reconnect(alternate)
+            else:
+                remote_addr = alternate
+
+    def _server_addr(self, remote_addr=None):
+        """ip and port of the server of the request"""
+        if remote_addr is not None:
+            return tuple(remote_addr[:2])
+        if self._transport is not None:
+            peername = self._transport.get_extra_info("peername")
+            if peername is not None:
+                return tuple(peername[:2])
+        return (self._host, self._port)
+
+    def _alternate(self, resp):
+        """ip and port of the alternate server of a 300 response, or None"""
+        if not resp or resp.msgclass != constants.CLASS_ERROR:
+            return None
+        err = resp.get_attribute(attribute.AttrErrorCode)
+        alternate = resp.get_attribute(attribute.AttrAlternateServer)
+        if err is None or alternate is None or err.params["code"] != 300:
+            return None
+        return (alternate.params["ip"], alternate.params["port"])
+
+    async def _reconnect(self, alternate):
+        """move the connected transport to the alternate server
+
+        the streams and the demultiplexed protocols are kept, and a udp
+        socket is bound again to the same local address to keep the local
+        port and its nat mapping. When the alternate server can not be
+        reached, the client stays connected to the previous one.
+        """
+        previous = (self._host, self._port, self._transport, self._protocol)
+        local_addr = self.get_local_addr()
+        if self._ipproto == constants.IPPROTO_UDP:
+            # the local port is released before being bound again
+            self._detach(self._transport, self._protocol)
+            await asyncio.sleep(0)
+
+        (self._host, self._port) = alternate
+        bound = (self._local_addr, self._local_port)
+        if self._ipproto == constants.IPPROTO_UDP and local_addr is not None:
+            (self._local_addr, self._local_port) = local_addr[:2]
+        try:
+            await self.connect()
+        except (RuntimeError, OSError):
+            (self._host, self._port) = previous[:2]
+            if self._ipproto == constants.IPPROTO_UDP:
+                await self.connect()
+            else:
+                (self._transport, self._protocol) = previous[2:]
+                self._stun_codec.send = self._protocol.send
+                self._stun_codec.transport = self._transport
+            raise
+        finally:
+            (self._local_addr, self._local_port) = bound
+
+        if self._ipproto != constants.IPPROTO_UDP:
+            self._detach(*previous[2:])
+
+    def _detach(self, transport, protocol):
+        """close a transport without ending the streams"""
+        if protocol is not None:
+            protocol.detach()
+        if transport is not None:
+            transport.close()
+
+    async def _bind_once(self, use_classicstun, attrs, remote_addr, record_health=True):
+        """send one bind request and wait for its response"""
         stun_proto = stun.Message
         if use_classicstun:
             stun_proto = stun.ClassicMessage
@@ -187,28 +443,63 @@ class Client:
         stun_req = stun_proto(constants.CLASS_REQUEST, constants.METHOD_BINDING, attrs)
 
         # send it
+        sent_at = asyncio.get_running_loop().time()
         success = self.send_request(req=stun_req, remote_addr=remote_addr)
         if not success:
             return {}
 
+        try:
+            return await self._bind_response(stun_req, sent_at, remote_addr, record_health)
+        finally:
+            self._stun_codec.pending.pop(stun_req.transaction_id, None)
+
+    async def _bind_response(self, stun_req, sent_at, remote_addr, record_health=True):
+        """wait for the response of the bind request, with retransmissions"""
+        # retransmit over udp, the rto is doubled after each attempt
+        # https://www.rfc-editor.org/rfc/rfc5389#section-7.2.1
+        resp = None
+        if self._ipproto == constants.IPPROTO_UDP:
+            rto = self._rto
+            for _ in range(self._retransmissions):
+                resp = await self._wait_match(stun_req, rto)
+                if resp is not None:
+                    break
+                if self._metrics is not None:
+                    self._metrics.inc(stun_metrics.RETRANSMITS)
+                if self._tracer is not None:
+                    self._tracer(tracing.EVENT_RETRANSMIT, stun_req.transaction_id, time.monotonic())
+                self.send_request(req=stun_req, remote_addr=remote_addr)
+                rto *= 2
+
         # wait for response
-        resp = await self.wait_for_resp()
         if resp is None:
+            resp = await self._wait_match(stun_req, self._timeout)
+        if resp is None:
+            if self._health is not None and record_health:
+                self._health.record_failure(*self._health_key(remote_addr))
+            if self._metrics is not None:
+                self._metrics.inc(stun_metrics.TIMEOUTS)
+            if self._tracer is not None:
+                self._tracer(tracing.EVENT_TIMEOUT, stun_req.transaction_id, time.monotonic())
             return None
 
-        # If the message class is "Success Response" or "Error Response"
-        # checks that the transaction ID matches the request
         if resp.msgclass in [constants.CLASS_SUCCESS, constants.CLASS_ERROR]:
-            if stun_req.transaction_id != resp.transaction_id:
-                return None
+            if self._health is not None and record_health:
+                self._health.record_success(*self._health_key(remote_addr), rtt=asyncio.get_running_loop().time() - sent_at)
+            if self._metrics is not None:
+                labels = {"server": self._server_label(remote_addr)}
+                self._metrics.inc(stun_metrics.RESPONSES_MATCHED)
+                self._metrics.observe(stun_metrics.RTT_SECONDS, asyncio.get_running_loop().time() - sent_at, labels=labels)
+            if self._tracer is not None:
+                self._tracer(tracing.EVENT_MATCHED, stun_req.transaction_id, time.monotonic())
 
         return resp
 
-    async def get_mapped_address(self, use_classicstun=False):
+    async def get_mapped_address(self, use_classicstun=False, remote_addr=None):
         """get mapped address"""
         mapped_addr = {}
 
-        resp = await self.bind_request(use_classicstun=use_classicstun)
+        resp = await self.bind_request(use_classicstun=use_classicstun, remote_addr=remote_addr)
         if resp is None:
             return mapped_addr
 
@@ -10,6 +10,11 @@ IPPROTO_NAMES = {
     IPPROTO_TLS: "TLS",
 }
 
+# overflow policies of the receive queue
+QUEUE_DROP_OLDEST = 1
+QUEUE_DROP_NEWEST = 2
+QUEUE_PAUSE_READING = 3
+
 FAMILY_IP4 = 0x01
 FAMILY_IP6 = 0x02
 
@@ -21,6 +26,10 @@ FAMILY_NAMES = {
 MAGIC_COOKIE = 0x2112A442
 STUN_HEADER_SIZE = 20
 
+# bounds of the decoder, larger messages or more attributes are rejected
+STUN_MAX_SIZE = 4096
+STUN_MAX_ATTRIBUTES = 32
+
 CLASS_REQUEST = 0
 CLASS_INDICATION = 1
 CLASS_SUCCESS = 2
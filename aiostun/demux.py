@@ -0,0 +1,91 @@
+from aiostun import client
+from aiostun import metrics as stun_metrics
+
+# https://www.rfc-editor.org/rfc/rfc7983#section-7
+#                  +----------------+
+#                  |        [0..3] -+--> forward to STUN
+#                  |                |
+#                  |      [16..19] -+--> forward to ZRTP
+#                  |                |
+#      packet -->  |      [20..63] -+--> forward to DTLS
+#                  |                |
+#                  |      [64..79] -+--> forward to TURN Channel
+#                  |                |
+#                  |    [128..191] -+--> forward to RTP/RTCP
+#                  +----------------+
+PACKET_STUN = "stun"
+PACKET_ZRTP = "zrtp"
+PACKET_DTLS = "dtls"
+PACKET_TURN_CHANNEL = "turn-channel"
+PACKET_RTP = "rtp"
+
+PACKET_RANGES = {
+    PACKET_STUN: (0, 3),
+    PACKET_ZRTP: (16, 19),
+    PACKET_DTLS: (20, 63),
+    PACKET_TURN_CHANNEL: (64, 79),
+    PACKET_RTP: (128, 191),
+}
+
+def classify(data):
+    """kind of packet from its first byte, None if unknown"""
+    if not data:
+        return None
+    first = data[0]
+    for kind, (low, high) in PACKET_RANGES.items():
+        if low <= first <= high:
+            return kind
+    return None
+
+class DemuxProtocol(client.TransportProtocol):
+    def __init__(self, client, proto, metrics=None):
+        """init"""
+        super().__init__(client, proto, metrics)
+        # one entry per first byte value, None when no protocol is registered
+        self._routes = [None] * 256
+        self._protocols = {}
+
+    def register(self, kind, protocol):
+        """route the packets of this kind to the protocol, None to unregister
+
+        the protocol receives connection_made(transport) with the shared
+        transport and datagram_received(data, addr) with the datagram as is.
+        """
+        if kind == PACKET_STUN:
+            raise ValueError("STUN packets are always handled by the codec")
+        (low, high) = PACKET_RANGES[kind]
+        for first in range(low, high + 1):
+            self._routes[first] = protocol
+        if protocol is None:
+            self._protocols.pop(kind, None)
+            return
+        self._protocols[kind] = protocol
+        if self._transport is not None:
+            protocol.connection_made(self._transport)
+
+    def connection_made(self, transport):
+        """on connection made"""
+        super().connection_made(transport)
+        for protocol in self._protocols.values():
+            protocol.connection_made(transport)
+
+    def datagram_received(self, data, addr):
+        """on udp datagram received, only stun goes to the codec"""
+        if data and data[0] < 4:
+            self._client.feed_datagram(data)
+            return
+
+        protocol = self._routes[data[0]] if data else None
+        if protocol is not None:
+            protocol.datagram_received(data, addr)
+        elif self._metrics is not None:
+            self._metrics.inc(stun_metrics.DEMUX_DROPPED)
+
+    def connection_lost(self, exc):
+        """on connection lost"""
+        super().connection_lost(exc)
+        if self._detached:
+            return
+        for protocol in self._protocols.values():
+            if hasattr(protocol, "connection_lost"):
+                protocol.connection_lost(exc)
@@ -0,0 +1,179 @@
+import os
+import time
+import socket
+import struct
+import asyncio
+
+from aiostun import constants
+from aiostun import client
+from aiostun import nat
+
+# ioctl to read the ipv4 address of an interface, linux only
+SIOCGIFADDR = 0x8915
+
+# public addresses used to find the source address of the default route,
+# nothing is sent to them
+DEFAULT_ROUTE_IP4 = "192.0.2.1"
+DEFAULT_ROUTE_IP6 = "2001:db8::1"
+
+def _psutil_addresses():
+    """addresses of the interfaces with psutil, None if not installed"""
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    addresses = []
+    for ifname, addrs in psutil.net_if_addrs().items():
+        for addr in addrs:
+            if addr.family == socket.AF_INET:
+                addresses.append((ifname, constants.FAMILY_IP4, addr.address))
+            elif addr.family == socket.AF_INET6:
+                addresses.append((ifname, constants.FAMILY_IP6, addr.address.partition("%")[0]))
+    return addresses
+
+def _linux_addresses():
+    """addresses of the interfaces from the kernel, None if not available"""
+    try:
+        import fcntl
+        ifnames = socket.if_nameindex()
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, ifname in ifnames:
+            try:
+                ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack("256s", ifname.encode()[:15]))
+            except OSError:
+                # no ipv4 address on this interface
+                continue
+            addresses.append((ifname, constants.FAMILY_IP4, socket.inet_ntoa(ifreq[20:24])))
+
+    # address, index, prefix length, scope, flags, name
+    if os.path.exists("/proc/net/if_inet6"):
+        with open("/proc/net/if_inet6") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 6:
+                    continue
+                ip = socket.inet_ntop(socket.AF_INET6, bytes.fromhex(fields[0]))
+                addresses.append((fields[5], constants.FAMILY_IP6, ip))
+    return addresses
+
+def _route_addresses():
+    """source addresses of the default routes"""
+    addresses = []
+    for family, af, ip in [ (constants.FAMILY_IP4, socket.AF_INET, DEFAULT_ROUTE_IP4),
+                            (constants.FAMILY_IP6, socket.AF_INET6, DEFAULT_ROUTE_IP6) ]:
+        try:
+            with socket.socket(af, socket.SOCK_DGRAM) as s:
+                s.connect((ip, 9))
+                addresses.append((None, family, s.getsockname()[0]))
+        except OSError:
+            continue
+    return addresses
+
+def local_addresses(include_loopback=False, include_link_local=False):
+    """list of (interface, family, ip) of the local ipv4 and ipv6 addresses
+
+    psutil is used when installed, otherwise the addresses are read from
+    the kernel on linux. Elsewhere only the source addresses of the default
+    routes are found, without the interface name.
+    """
+    addresses = _psutil_addresses()
+    if addresses is None:
+        addresses = _linux_addresses()
+    if addresses is None:
+        addresses = _route_addresses()
+
+    result = []
+    for ifname, family, ip in addresses:
+        if family == constants.FAMILY_IP4:
+            loopback = ip.startswith("127.")
+            link_local = ip.startswith("169.254.")
+        else:
+            loopback = ip == "::1"
+            link_local = ip.lower().startswith("fe80:")
+        if loopback and not include_loopback:
+            continue
+        if link_local and not include_link_local:
+            continue
+        if (ifname, family, ip) not in result:
+            result.append((ifname, family, ip))
+    return result
+
+async def _resolve(host, port, family):
+    """resolve the host once per family, so that probes do not block on dns"""
+    loop = asyncio.get_running_loop()
+    af = socket.AF_INET6 if family == constants.FAMILY_IP6 else socket.AF_INET
+    infos = await loop.getaddrinfo(host, port, family=af, type=socket.SOCK_DGRAM)
+    return infos[0][4][0]
+
+async def _probe(ifname, family, ip, stun_ip, stun_port, use_nat, timeout, metrics, tracer):
+    """mapped address and nat behavior seen from one local address"""
+    report = { "interface": ifname, "family": family, "local-ip": ip }
+    start = time.perf_counter()
+    try:
+        stun_client = client.Client(host=stun_ip, port=stun_port, family=family,
+                                    proto=constants.IPPROTO_UDP, timeout=timeout,
+                                    local_addr=ip, local_port=0,
+                                    metrics=metrics, tracer=tracer)
+        await stun_client.connect()
+        try:
+            report["mapped-address"] = await stun_client.get_mapped_address()
+        finally:
+            stun_client.close()
+        report["mapped-duration"] = time.perf_counter() - start
+
+        if use_nat:
+            nat_discovery = nat.NAT(metrics=metrics, tracer=tracer)
+            report["nat"] = await nat_discovery.classic_discover(stun_host=stun_ip, stun_port=stun_port,
+                                                                  family=family, local_addr=ip)
+    except Exception as e:
+        # one address failing must not lose the reports of the others
+        report["error"] = str(e) or e.__class__.__name__
+    report["duration"] = time.perf_counter() - start
+    return report
+
+async def discover_all(stun_host=nat.NAT.__DEFAULT_STUN_HOST__, stun_port=nat.NAT.__DEFAULT_STUN_PORT__,
+                       addresses=None, use_nat=True, timeout=2, metrics=None, tracer=None):
+    """run the mapped address and nat probes on all local addresses at once
+
+    addresses is a list of (interface, family, ip), by default the ones
+    of local_addresses(). The probes run concurrently, so the total time is
+    the one of the slowest probe and not their sum.
+    """
+    if addresses is None:
+        addresses = local_addresses()
+    start = time.perf_counter()
+
+    # resolve the stun server for each family in use
+    families = []
+    for _, family, _ in addresses:
+        if family not in families:
+            families.append(family)
+    resolved = await asyncio.gather(*[ _resolve(stun_host, stun_port, f) for f in families ],
+                                    return_exceptions=True)
+    stun_ips = dict(zip(families, resolved))
+
+    probes = []
+    for ifname, family, ip in addresses:
+        stun_ip = stun_ips[family]
+        if isinstance(stun_ip, Exception):
+            probes.append(_unresolved(ifname, family, ip, stun_host))
+            continue
+        probes.append(_probe(ifname, family, ip, stun_ip, stun_port, use_nat, timeout, metrics, tracer))
+
+    interfaces = await asyncio.gather(*probes, return_exceptions=True)
+    for i, report in enumerate(interfaces):
+        if isinstance(report, BaseException):
+            (ifname, family, ip) = addresses[i]
+            interfaces[i] = { "interface": ifname, "family": family, "local-ip": ip,
+                              "error": str(report) or report.__class__.__name__, "duration": 0.0 }
+    return { "interfaces": list(interfaces), "duration": time.perf_counter() - start }
+
+async def _unresolved(ifname, family, ip, stun_host):
+    """report of an address without stun server in its family"""
+    return { "interface": ifname, "family": family, "local-ip": ip,
+             "error": "Unable to resolve %s" % stun_host, "duration": 0.0 }
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+
+from aiostun import constants
+from aiostun import client
+
+# states of the circuit breaker of a server
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+class ServerHealth:
+    def __init__(self, host, port, proto, family):
+        """health of one server, rtt and loss are moving averages"""
+        self.host = host
+        self.port = port
+        self.proto = proto
+        self.family = family
+        self.rtt = None
+        self.loss = 0.0
+        self.failures = 0
+        self.state = STATE_CLOSED
+        self.opened_at = 0.0
+
+    def key(self):
+        """key of the server in the registry"""
+        return (self.host, self.port, self.proto, self.family)
+
+    def to_dict(self):
+        """to json"""
+        return { "host": self.host, "port": self.port, "proto": self.proto, "family": self.family,
+                 "rtt": self.rtt, "loss": self.loss, "failures": self.failures,
+                 "state": self.state, "opened-at": self.opened_at }
+
+    def from_dict(self, d):
+        """restore the state saved by to_dict"""
+        self.rtt = d.get("rtt")
+        self.loss = d.get("loss", 0.0)
+        self.failures = d.get("failures", 0)
+        self.state = d.get("state", STATE_CLOSED)
+        self.opened_at = d.get("opened-at", 0.0)
+        return self
+
+class ServerRegistry:
+    def __init__(self, servers=None, path=None, alpha=0.2, failure_threshold=3,
+                 reset_timeout=30.0, timeout=2, unknown_rtt=0.5):
+        """health of a list of stun servers, to pick the best one first
+
+        servers is a list of (host, port, proto, family). After
+        failure_threshold timeouts in a row the circuit of a server is
+        opened and it is skipped for reset_timeout seconds, then one request
+        is allowed to test it again. With path, the state is loaded from and
+        saved to this json file.
+        """
+        self.path = path
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        self.unknown_rtt = unknown_rtt
+        self.servers = {}
+
+        for server in servers or []:
+            self.add(*server)
+        if path is not None:
+            self.load()
+
+    def add(self, host, port=3478, proto=constants.IPPROTO_UDP, family=constants.FAMILY_IP4):
+        """add a server, return its health"""
+        key = (host, port, proto, family)
+        if key not in self.servers:
+            self.servers[key] = ServerHealth(host, port, proto, family)
+        return self.servers[key]
+
+    def record_success(self, host, port, proto, family, rtt):
+        """a response has been received after rtt seconds, unknown servers are ignored"""
+        server = self.servers.get((host, port, proto, family))
+        if server is None:
+            return
+        server.rtt = rtt if server.rtt is None else (1 - self.alpha) * server.rtt + self.alpha * rtt
+        server.loss = (1 - self.alpha) * server.loss
+        server.failures = 0
+        server.state = STATE_CLOSED
+
+    def record_failure(self, host, port, proto, family, now=None):
+        """no response, the circuit is opened after too many failures"""
+        server = self.servers.get((host, port, proto, family))
+        if server is None:
+            return
+        if now is None:
+            now = time.time()
+        server.loss = (1 - self.alpha) * server.loss + self.alpha
+        server.failures += 1
+        if server.state == STATE_HALF_OPEN or server.failures >= self.failure_threshold:
+            server.state = STATE_OPEN
+            server.opened_at = now
+
+    def score(self, server):
+        """expected time to get a response, lower is better"""
+        rtt = self.unknown_rtt if server.rtt is None else server.rtt
+        return (1 - server.loss) * rtt + server.loss * self.timeout
+
+    def available(self, server, now=None):
+        """false while the circuit is open or its trial request is running"""
+        if server.state == STATE_CLOSED:
+            return True
+        if now is None:
+            now = time.time()
+        return now - server.opened_at >= self.reset_timeout
+
+    def take(self, server, now=None):
+        """the server is going to be used, an open circuit gives its one trial request
+
+        a trial without outcome is given again after another reset timeout
+        """
+        if server.state == STATE_CLOSED:
+            return server
+        if now is None:
+            now = time.time()
+        server.state = STATE_HALF_OPEN
+        server.opened_at = now
+        return server
+
+    def best(self, proto=None, family=None, now=None):
+        """available servers sorted by score, the configuration order breaks ties"""
+        servers = [ s for s in self.servers.values()
+                    if (proto is None or s.proto == proto) and (family is None or s.family == family) ]
+        servers = [ s for s in servers if self.available(s, now) ]
+        return sorted(servers, key=self.score)
+
+    def pick(self, proto=None, family=None, now=None):
+        """best available server, None if all circuits are open"""
+        servers = self.best(proto, family, now)
+        if not servers:
+            return None
+        return self.take(servers[0], now)
+
+    def load(self):
+        """load the saved state, a missing or corrupted file is ignored
+
+        only the configured servers are restored, all of them when the
+        registry has been created without servers
+        """
+        configured = len(self.servers) > 0
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            for d in saved["servers"]:
+                key = (d["host"], d["port"], d["proto"], d["family"])
+                if configured and key not in self.servers:
+                    continue
+                self.add(*key).from_dict(d)
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def save(self):
+        """save the state, the file is replaced atomically"""
+        tmp = "%s.tmp" % self.path
+        with open(tmp, "w") as f:
+            json.dump({ "servers": [ s.to_dict() for s in self.servers.values() ] }, f)
+        os.replace(tmp, self.path)
+
+    async def get_mapped_address(self, use_classicstun=False, proto=constants.IPPROTO_UDP,
+                                 family=constants.FAMILY_IP4, attempts=3, **kwargs):
+        """get the mapped address from the best servers, the next one is tried on failure
+
+        the other arguments are the ones of aiostun.Client
+        """
+        for server in self.best(proto, family)[:attempts]:
+            self.take(server)
+            c = client.Client(host=server.host, port=server.port, proto=proto, family=family,
+                              timeout=self.timeout, health=self, **kwargs)
+            try:
+                await c.connect()
+                mapped_addr = await c.get_mapped_address(use_classicstun=use_classicstun)
+            except (RuntimeError, OSError):
+                self.record_failure(*server.key())
+                continue
+            finally:
+                c.close()
+            if mapped_addr:
+                return mapped_addr
+        return {}
@@ -0,0 +1,146 @@
+# default buckets (in seconds) for the rtt histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# metrics names
+REQUESTS_SENT = "requests_sent"
+RESPONSES_MATCHED = "responses_matched"
+RESPONSES_UNMATCHED = "responses_unmatched"
+TIMEOUTS = "timeouts"
+RETRANSMITS = "retransmits"
+DECODE_ERRORS = "decode_errors"
+UNKNOWN_ATTRIBUTES = "unknown_attributes"
+TRANSPORT_ERRORS = "transport_errors"
+BYTES_IN = "bytes_in"
+BYTES_OUT = "bytes_out"
+QUEUE_DEPTH = "queue_depth"
+QUEUE_DROPPED = "queue_dropped"
+RTT_SECONDS = "rtt_seconds"
+DEMUX_DROPPED = "demux_dropped"
+REQUESTS_RECEIVED = "requests_received"
+RRL_DROPPED = "rrl_dropped"
+RRL_SLIPPED = "rrl_slipped"
+REDIRECTS_SENT = "redirects_sent"
+REDIRECTS_FOLLOWED = "redirects_followed"
+
+class Metrics:
+    """metrics interface, subclass it to plug your own backend"""
+    def inc(self, name, value=1, labels=None):
+        """increment a counter"""
+        pass
+
+    def set(self, name, value, labels=None):
+        """set a gauge"""
+        pass
+
+    def observe(self, name, value, labels=None):
+        """add a value to a histogram"""
+        pass
+
+class Registry(Metrics):
+    def __init__(self, prefix="aiostun", buckets=DEFAULT_BUCKETS):
+        """init"""
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        """hashable key for a metric and its labels"""
+        if not labels:
+            return (name, ())
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, labels=None):
+        """increment a counter"""
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        """set a gauge"""
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        """add a value to a histogram"""
+        key = self._key(name, labels)
+        h = self.histograms.get(key)
+        if h is None:
+            h = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            self.histograms[key] = h
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                h["buckets"][i] += 1
+        h["sum"] += value
+        h["count"] += 1
+
+    def get(self, name, labels=None):
+        """return the current value of a counter or gauge, or the histogram"""
+        key = self._key(name, labels)
+        if key in self.counters:
+            return self.counters[key]
+        if key in self.gauges:
+            return self.gauges[key]
+        return self.histograms.get(key)
+
+    def to_prometheus(self):
+        """render all metrics in the prometheus text exposition format"""
+        ret = []
+
+        def fmt_labels(labels, extra=()):
+            labels = labels + extra
+            if not labels:
+                return ""
+            pairs = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels]
+            return "{%s}" % ",".join(pairs)
+
+        def by_name(metrics):
+            names = {}
+            for (name, labels), value in sorted(metrics.items()):
+                names.setdefault(name, []).append((labels, value))
+            return names.items()
+
+        for name, values in by_name(self.counters):
+            fullname = "%s_%s_total" % (self.prefix, name)
+            ret.append("# TYPE %s counter" % fullname)
+            for labels, value in values:
+                ret.append("%s%s %s" % (fullname, fmt_labels(labels), value))
+
+        for name, values in by_name(self.gauges):
+            fullname = "%s_%s" % (self.prefix, name)
+            ret.append("# TYPE %s gauge" % fullname)
+            for labels, value in values:
+                ret.append("%s%s %s" % (fullname, fmt_labels(labels), value))
+
+        for name, values in by_name(self.histograms):
+            fullname = "%s_%s" % (self.prefix, name)
+            ret.append("# TYPE %s histogram" % fullname)
+            for labels, h in values:
+                for le, count in zip(self.buckets, h["buckets"]):
+                    ret.append("%s_bucket%s %s" % (fullname, fmt_labels(labels, (("le", le),)), count))
+                ret.append("%s_bucket%s %s" % (fullname, fmt_labels(labels, (("le", "+Inf"),)), h["count"]))
+                ret.append("%s_sum%s %s" % (fullname, fmt_labels(labels), h["sum"]))
+                ret.append("%s_count%s %s" % (fullname, fmt_labels(labels), h["count"]))
+
+        ret.append("")
+        return "\n".join(ret)
+
+async def start_http_server(registry, host="127.0.0.1", port=9464):
+    """expose the registry to a prometheus scraper over http"""
+    import asyncio
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        body = registry.to_prometheus().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\n")
+        writer.write(b"Content-Type: text/plain; version=0.0.4\r\n")
+        writer.write(b"Content-Length: %d\r\n" % len(body))
+        writer.write(b"Connection: close\r\n\r\n")
+        writer.write(body)
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, host=host, port=port)
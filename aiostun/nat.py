@@ -1,4 +1,9 @@
 
+import time
+import socket
+import asyncio
+import collections
+
 from aiostun import client
 from aiostun import constants
 from aiostun import attribute
@@ -12,9 +17,91 @@ SYMMETRIC_NAT = "Symmetric NAT"
 RESTRICTED_NAT = "Restricted NAT"
 RESTRICTED_PORT_NAT = "Restricted Port NAT"
 
+# port allocation patterns
+ALLOC_PORT_PRESERVING = "Port Preserving"
+ALLOC_SEQUENTIAL = "Sequential"
+ALLOC_RANDOM = "Random"
+
+# mapping behaviour, https://www.rfc-editor.org/rfc/rfc4787#section-4.1
+MAPPING_ENDPOINT_INDEPENDENT = "Endpoint Independent"
+MAPPING_ENDPOINT_DEPENDENT = "Endpoint Dependent"
+
+def port_delta(a, b):
+    """signed difference between two ports, with wrap around"""
+    return ((b - a + 32768) % 65536) - 32768
+
+def classify_port_allocation(samples, sequential_ratio=0.5, preserving_ratio=0.9):
+    """classify how the nat allocates the external ports
+
+    samples are dicts with the local port, the server and the mapped port,
+    listed in the order the requests were sent.
+    """
+    result = {}
+    samples = [ s for s in samples if s.get("mapped-port") is not None ]
+    result["samples"] = len(samples)
+    if not samples:
+        result["error"] = NETWORK_ERROR
+        return result
+
+    # same external port for a socket whatever the server ?
+    mapped = collections.defaultdict(set)
+    for s in samples:
+        mapped[s["local-port"]].add(s["mapped-port"])
+    if all(len(ports) == 1 for ports in mapped.values()):
+        result["mapping"] = MAPPING_ENDPOINT_INDEPENDENT
+    else:
+        result["mapping"] = MAPPING_ENDPOINT_DEPENDENT
+
+    preserved = sum(1 for s in samples if s["mapped-port"] == s["local-port"])
+    if preserved >= preserving_ratio * len(samples):
+        result["allocation"] = ALLOC_PORT_PRESERVING
+        result["predicted-ports"] = None
+        return result
+
+    # deltas between new mappings in the order of allocation
+    ports = []
+    seen = set()
+    for s in samples:
+        key = (s["local-port"], s["mapped-port"])
+        if key not in seen:
+            seen.add(key)
+            ports.append(s["mapped-port"])
+    deltas = [ port_delta(a, b) for a, b in zip(ports, ports[1:]) ]
+
+    if deltas:
+        (delta, count) = collections.Counter(deltas).most_common(1)[0]
+        if delta != 0 and count >= sequential_ratio * len(deltas):
+            # the gaps are caused by other flows allocated in the meantime
+            gaps = sorted(abs(d - delta) for d in deltas if d != delta)
+            spread = gaps[int(len(gaps) * 0.9)] if gaps else 0
+            start = (ports[-1] + delta) % 65536
+            result["allocation"] = ALLOC_SEQUENTIAL
+            result["delta"] = delta
+            # the range goes from the lowest to the highest port, the gaps
+            # move the next port further in the direction of delta
+            if delta > 0:
+                result["predicted-ports"] = (start, (start + spread) % 65536)
+            else:
+                result["predicted-ports"] = ((start - spread) % 65536, start)
+            return result
+
+    result["allocation"] = ALLOC_RANDOM
+    result["predicted-ports"] = (min(ports), max(ports))
+    return result
+
 class NAT:
     __DEFAULT_STUN_HOST__ = "turn.matrix.org"
     __DEFAULT_STUN_PORT__ = 3478
+    def __init__(self, metrics=None, tracer=None, health=None, network=None):
+        """init, with a health registry the best server is picked when no host is given
+
+        network is given to the clients, see aiostun.Client
+        """
+        self._metrics = metrics
+        self._tracer = tracer
+        self._health = health
+        self._network = network
+
     async def discover(self, use_classicstun=False, **kwargs):
         """Discovery NAT"""
         if use_classicstun:
@@ -22,41 +109,117 @@ class NAT:
 
         raise Exception("Not yet implemented")
 
-    async def classic_discover(self, stun_host=__DEFAULT_STUN_HOST__, stun_port=__DEFAULT_STUN_PORT__):
+    async def analyze_port_allocation(self, stun_servers, sockets=256, concurrency=256, timeout=2,
+                                      use_classicstun=False):
+        """open many sockets, query several servers from each and classify the port allocation"""
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+
+        # resolve once, not on each sendto
+        servers = []
+        for host, port in stun_servers:
+            if self._network is not None:
+                # simulated hosts are known by their ip
+                servers.append((host, port))
+                continue
+            infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            servers.append(infos[0][4][:2])
+
+        clients = []
+        for _ in range(sockets):
+            # bind explicitly to know the local port before the first request
+            c = client.Client(host=servers[0][0], port=servers[0][1],
+                              family=constants.FAMILY_IP4, proto=constants.IPPROTO_UDP,
+                              local_addr="0.0.0.0", local_port=0,
+                              timeout=timeout, metrics=self._metrics, tracer=self._tracer,
+                              network=self._network)
+            clients.append(c)
+
+        samples = []
+        order = iter(range(sockets * len(servers)))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def probe(c):
+            async with semaphore:
+                (_, local_port) = c.get_local_addr()
+                for server in servers:
+                    sample = {"order": next(order), "local-port": local_port, "server": server}
+                    samples.append(sample)
+                    mapped_addr = await c.get_mapped_address(use_classicstun=use_classicstun,
+                                                             remote_addr=server)
+                    sample["mapped-port"] = mapped_addr.get("port")
+                    sample["mapped-ip"] = mapped_addr.get("ip")
+
+        try:
+            # every socket stay open until the end, so the nat keeps all the mappings
+            await asyncio.gather(*[ c.connect(remote_addr=False) for c in clients ])
+            await asyncio.gather(*[ probe(c) for c in clients ])
+        finally:
+            for c in clients:
+                c.close()
+
+        samples.sort(key=lambda s: s["order"])
+        result = classify_port_allocation(samples)
+        result["duration"] = time.monotonic() - started
+        result["details"] = samples
+        return result
+
+    async def classic_discover(self, stun_host=None, stun_port=__DEFAULT_STUN_PORT__,
+                               family=constants.FAMILY_IP4, local_addr=None):
         """discover like described in the rfc3489"""
+        if stun_host is None:
+            server = None
+            if self._health is not None:
+                server = self._health.pick(constants.IPPROTO_UDP, family)
+            if server is None:
+                stun_host = self.__DEFAULT_STUN_HOST__
+            else:
+                (stun_host, stun_port) = (server.host, server.port)
+
+        stun_test = client.Client(host=stun_host, port=stun_port,
+                                  family=family,
+                                  proto=constants.IPPROTO_UDP,
+                                  local_addr=local_addr, local_port=0,
+                                  metrics=self._metrics,
+                                  tracer=self._tracer,
+                                  health=self._health,
+                                  network=self._network)
+        # connect and get the local ip and port
+        await stun_test.connect(remote_addr=False)
+        try:
+            return await self._classic_tests(stun_test, stun_host, stun_port)
+        finally:
+            stun_test.close()
+
+    async def _classic_tests(self, stun_test, stun_host, stun_port):
+        """run the tests of the rfc3489 with the connected client"""
         nat_behavior = {}
         use_classicstun = True
 
         # Test I: the client sends a STUN Binding Request to a server,
         # without any flags set in the CHANGE-REQUEST attribute,
         # and without the RESPONSE-ADDRESS attribute.
-        stun_test = client.Client(host=stun_host, port=stun_port,
-                                  family=constants.FAMILY_IP4,
-                                  proto=constants.IPPROTO_UDP)
-        # connect and get the local ip and port
-        await stun_test.connect(remote_addr=False)
-
         # Send bind request without any flag
         # if no response, the reason can be multiple: UDP blocked ? network issue ? or the server is down ?
         resp_test1 = await stun_test.bind_request(use_classicstun=use_classicstun, remote_addr=(stun_host, stun_port))
-        if resp_test1 is None:
+        if not resp_test1:
            nat_behavior["error"] = NETWORK_ERROR
            return nat_behavior
 
         # read local port
-        (local_ipI, local_portI) = stun_test.get_local_addr()
+        (local_ipI, local_portI) = stun_test.get_local_addr()[:2]
         nat_behavior["local-ip"] = local_ipI
         nat_behavior["local-port"] = local_portI
 
         # if the mapped addr  and changed addr is missing, something is wrong
         mappedAddr = resp_test1.get_attribute(attribute.AttrMappedAddr)
+        if mappedAddr is None:
+            nat_behavior["error"] = PROTOCOL_ERROR
+            return nat_behavior
         nat_behavior["external-ip"] = mappedAddr.params["ip"]
         nat_behavior["external-port"] = mappedAddr.params["port"]
 
         changedaddr = resp_test1.get_attribute(attribute.AttrChangedAddress)
-        if mappedAddr is None:
-            nat_behavior["error"] = PROTOCOL_ERROR
-            return nat_behavior
         if changedaddr is None:
             nat_behavior["error"] = PROTOCOL_ERROR
             return nat_behavior
@@ -66,7 +229,9 @@ class NAT:
         attr_changereq = attribute.AttrChangeRequest(changeIp=True, changePort=True)
         resp_test2 = await stun_test.bind_request(use_classicstun=use_classicstun,
                                                   attrs=[attr_changereq],
-                                                  remote_addr=(stun_host, stun_port))
+                                                  remote_addr=(stun_host, stun_port),
+                                                  # no response is expected behind a filtering nat
+                                                  record_health=False)
 
         if mappedAddr.params["ip"] == local_ipI and resp_test2 is None:
             nat_behavior["nat"] = SYMMETRIC_UDP_FIREWALL
@@ -87,7 +252,7 @@ class NAT:
             remote_addr = (changedaddr.params["ip"], changedaddr.params["port"])
             resp_test1_again = await stun_test.bind_request(use_classicstun=use_classicstun,
                                                             attrs=[], remote_addr=remote_addr)
-            if resp_test1_again is None:
+            if not resp_test1_again:
                 nat_behavior["error"] = PROTOCOL_ERROR
                 return nat_behavior
 
@@ -105,7 +270,8 @@ class NAT:
             remote_addr = (changedaddr.params["ip"], changedaddr.params["port"])
             resp_test3 = await stun_test.bind_request(use_classicstun=use_classicstun,
                                                       attrs=[attr_changereq3],
-                                                      remote_addr=remote_addr)
+                                                      remote_addr=remote_addr,
+                                                      record_health=False)
             if resp_test3:
                 nat_behavior["nat"] = RESTRICTED_NAT
                 return nat_behavior
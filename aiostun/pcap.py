@@ -0,0 +1,495 @@
+import os
+import mmap
+import socket
+import struct
+import collections
+
+from aiostun import stun
+
+# pcap magic numbers, https://www.ietf.org/archive/id/draft-ietf-opsawg-pcap-03.html
+PCAP_MAGIC_USEC = 0xA1B2C3D4
+PCAP_MAGIC_NSEC = 0xA1B23C4D
+
+# pcapng blocks, https://www.ietf.org/archive/id/draft-ietf-opsawg-pcapng-01.html
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER = 0x1A2B3C4D
+PCAPNG_OPT_TSRESOL = 9
+
+# link layer types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IP4 = 0x0800
+ETHERTYPE_IP6 = 0x86DD
+ETHERTYPE_VLAN = [0x8100, 0x88A8]
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+# ipv6 extension headers skipped to find the transport
+IP6_EXT_HEADERS = [0, 43, 60]
+IP6_FRAGMENT = 44
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+class Packet:
+    def __init__(self, timestamp, proto, src, dst, payload):
+        """init"""
+        self.timestamp = timestamp
+        self.proto = proto
+        self.src = src
+        self.dst = dst
+        self.payload = payload
+
+    def _format(self, addr):
+        """format a raw (ip, port) tuple"""
+        family = socket.AF_INET if len(addr[0]) == 4 else socket.AF_INET6
+        return (socket.inet_ntop(family, addr[0]), addr[1])
+
+    def src_addr(self):
+        """source ip and port"""
+        return self._format(self.src)
+
+    def dst_addr(self):
+        """destination ip and port"""
+        return self._format(self.dst)
+
+def is_stun(payload, stream=False):
+    """cheap check of a datagram payload: top bits, length and padding
+
+    with stream, the payload is the start of a tcp stream, it can hold a
+    part of a message or several ones, only the header and the magic cookie
+    of the first message are checked
+    """
+    if len(payload) < stun.constants.STUN_HEADER_SIZE or payload[0] & 0xC0:
+        return False
+    length = (payload[2] << 8) | payload[3]
+    if stream:
+        return length % 4 == 0 and struct.unpack_from("!L", payload, 4)[0] == stun.constants.MAGIC_COOKIE
+    return length % 4 == 0 and length + stun.constants.STUN_HEADER_SIZE == len(payload)
+
+def parse_frame(linktype, frame):
+    """walk the link, ip and transport headers of a frame without copy
+
+    return (proto, src, dst, payload, tcp) or None, with tcp the (seq, flags)
+    tuple for tcp segments.
+    """
+    # link layer
+    if linktype == LINKTYPE_ETHERNET:
+        if len(frame) < 14:
+            return None
+        ethertype = (frame[12] << 8) | frame[13]
+        pos = 14
+        while ethertype in ETHERTYPE_VLAN and len(frame) >= pos + 4:
+            ethertype = (frame[pos + 2] << 8) | frame[pos + 3]
+            pos += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16:
+            return None
+        ethertype = (frame[14] << 8) | frame[15]
+        pos = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(frame) < 20:
+            return None
+        ethertype = (frame[0] << 8) | frame[1]
+        pos = 20
+    elif linktype == LINKTYPE_NULL:
+        if len(frame) < 4:
+            return None
+        # address family in the byte order of the capturing host
+        (family,) = struct.unpack("<L", frame[:4])
+        if family > 0xFFFF:
+            (family,) = struct.unpack(">L", frame[:4])
+        ethertype = ETHERTYPE_IP4 if family == 2 else ETHERTYPE_IP6
+        pos = 4
+    elif linktype == LINKTYPE_RAW:
+        if len(frame) < 1:
+            return None
+        ethertype = ETHERTYPE_IP4 if frame[0] >> 4 == 4 else ETHERTYPE_IP6
+        pos = 0
+    else:
+        return None
+
+    # network layer, fragments are ignored
+    if ethertype == ETHERTYPE_IP4:
+        if len(frame) < pos + 20:
+            return None
+        ihl = (frame[pos] & 0x0F) * 4
+        (total_length, frag) = struct.unpack("!H2xH", frame[pos + 2:pos + 8])
+        if frag & 0x3FFF:
+            return None
+        proto = frame[pos + 9]
+        src_ip = frame[pos + 12:pos + 16]
+        dst_ip = frame[pos + 16:pos + 20]
+        end = min(pos + total_length, len(frame))
+        pos += ihl
+    elif ethertype == ETHERTYPE_IP6:
+        if len(frame) < pos + 40:
+            return None
+        (payload_length,) = struct.unpack("!H", frame[pos + 4:pos + 6])
+        proto = frame[pos + 6]
+        src_ip = frame[pos + 8:pos + 24]
+        dst_ip = frame[pos + 24:pos + 40]
+        end = min(pos + 40 + payload_length, len(frame))
+        pos += 40
+        while proto in IP6_EXT_HEADERS and end >= pos + 8:
+            proto = frame[pos]
+            pos += (frame[pos + 1] + 1) * 8
+        if proto == IP6_FRAGMENT:
+            return None
+    else:
+        return None
+
+    # transport layer
+    if proto == PROTO_UDP:
+        if end < pos + 8:
+            return None
+        (sport, dport) = struct.unpack("!HH", frame[pos:pos + 4])
+        src = (bytes(src_ip), sport)
+        dst = (bytes(dst_ip), dport)
+        return (PROTO_UDP, src, dst, frame[pos + 8:end], None)
+
+    if proto == PROTO_TCP:
+        if end < pos + 20:
+            return None
+        (sport, dport, seq) = struct.unpack("!HHL", frame[pos:pos + 8])
+        offset = (frame[pos + 12] >> 4) * 4
+        flags = frame[pos + 13]
+        src = (bytes(src_ip), sport)
+        dst = (bytes(dst_ip), dport)
+        return (PROTO_TCP, src, dst, frame[pos + offset:end], (seq, flags))
+
+    return None
+
+class TcpStream:
+    def __init__(self, max_pending=64):
+        """init, the codec is created once the stream is known to carry stun"""
+        self.codec = None
+        self.ignored = False
+        self.next_seq = None
+        self.pending = {}
+        self.max_pending = max_pending
+
+    def feed(self, seq, flags, payload):
+        """feed a segment in sequence order to the codec, return decoded messages"""
+        if flags & TCP_SYN:
+            self.next_seq = (seq + 1) & 0xFFFFFFFF
+            return []
+        if not len(payload) or self.ignored:
+            return []
+        if self.next_seq is None:
+            # capture started in the middle of the stream
+            self.next_seq = seq
+
+        delta = (seq - self.next_seq) & 0xFFFFFFFF
+        if delta >= 0x80000000:
+            # retransmission, keep only the new data
+            skip = (self.next_seq - seq) & 0xFFFFFFFF
+            if skip >= len(payload):
+                return []
+            payload = payload[skip:]
+            seq = self.next_seq
+            delta = 0
+
+        if delta > 0:
+            # out of order, wait for the missing data
+            self.pending[seq] = bytes(payload)
+            if len(self.pending) <= self.max_pending:
+                return []
+            # give up on the gap, restart from the first pending segment
+            seq = min(self.pending, key=lambda s: (s - self.next_seq) & 0xFFFFFFFF)
+            payload = self.pending.pop(seq)
+            if self.codec is not None:
+                self.codec.buf = b""
+
+        msgs = self._feed(payload)
+        self.next_seq = (seq + len(payload)) & 0xFFFFFFFF
+        while self.next_seq in self.pending:
+            payload = self.pending.pop(self.next_seq)
+            msgs.extend(self._feed(payload))
+            self.next_seq = (self.next_seq + len(payload)) & 0xFFFFFFFF
+        return msgs
+
+    def _feed(self, payload):
+        """feed the codec and drain its queue"""
+        if self.codec is None:
+            # the other tcp streams are not buffered
+            if not is_stun(payload, stream=True):
+                self.ignored = True
+                self.pending.clear()
+                return []
+            self.codec = stun.Codec(maxsize=0)
+        try:
+            self.codec.feed_data(payload)
+        except Exception:
+            # not stun or desynchronized, drop the buffer
+            self.codec.buf = b""
+        msgs = []
+        while not self.codec._queue.empty():
+            msgs.append(self.codec._queue.get_nowait())
+        return msgs
+
+class PcapReader:
+    def __init__(self, path):
+        """init"""
+        self.path = path
+        self._file = None
+        self._mmap = None
+        self.data = None
+        self.pcapng = False
+        self.endian = "<"
+        self.linktype = None
+        self.tsresol = 1e-6
+
+    def __enter__(self):
+        """enter"""
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        """exit"""
+        self.close()
+
+    def open(self):
+        """memory-map the capture and read the file header"""
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self._mmap)
+
+        if len(self.data) < 24:
+            self.close()
+            raise RuntimeError("Invalid capture file")
+
+        (magic,) = struct.unpack("<L", self.data[:4])
+        if magic == PCAPNG_SHB:
+            self.pcapng = True
+            (bom,) = struct.unpack("<L", self.data[8:12])
+            self.endian = "<" if bom == PCAPNG_BYTE_ORDER else ">"
+            return self
+
+        for endian in ["<", ">"]:
+            (magic,) = struct.unpack(endian + "L", self.data[:4])
+            if magic in [PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC]:
+                self.endian = endian
+                self.tsresol = 1e-6 if magic == PCAP_MAGIC_USEC else 1e-9
+                (self.linktype,) = struct.unpack(endian + "L", self.data[20:24])
+                return self
+
+        self.close()
+        raise RuntimeError("Unsupported capture format")
+
+    def close(self):
+        """unmap the capture"""
+        if self.data is not None:
+            self.data.release()
+            self.data = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # frames still referenced by the caller, closed when released
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def first_record(self):
+        """offset of the first record"""
+        return 0 if self.pcapng else 24
+
+    def records(self, start=None, end=None, interfaces=None):
+        """yield (timestamp, linktype, frame) for each record between the offsets"""
+        if start is None:
+            start = self.first_record()
+        if end is None:
+            end = len(self.data)
+        if self.pcapng:
+            yield from self._pcapng_records(start, end, interfaces)
+        else:
+            yield from self._pcap_records(start, end)
+
+    def _pcap_records(self, pos, end):
+        """walk pcap records"""
+        data = self.data
+        fmt = self.endian + "LLLL"
+        while pos + 16 <= end:
+            (ts_sec, ts_frac, caplen, _) = struct.unpack(fmt, data[pos:pos + 16])
+            pos += 16
+            if pos + caplen > len(data):
+                return
+            yield (ts_sec + ts_frac * self.tsresol, self.linktype, data[pos:pos + caplen])
+            pos += caplen
+
+    def _pcapng_records(self, pos, end, interfaces=None):
+        """walk pcapng blocks"""
+        data = self.data
+        e = self.endian
+        interfaces = list(interfaces) if interfaces else []
+        while pos + 12 <= end:
+            (block_type, block_length) = struct.unpack(e + "LL", data[pos:pos + 8])
+            if block_length < 12 or pos + block_length > len(data):
+                return
+            body = data[pos + 8:pos + block_length - 4]
+
+            if block_type == PCAPNG_SHB:
+                (bom,) = struct.unpack("<L", body[:4])
+                e = self.endian = "<" if bom == PCAPNG_BYTE_ORDER else ">"
+                interfaces = []
+            elif block_type == PCAPNG_IDB:
+                interfaces.append(self._read_idb(body, e))
+            elif block_type == PCAPNG_EPB and interfaces:
+                (if_id, ts_high, ts_low, caplen) = struct.unpack(e + "LLLL", body[:16])
+                linktype, tsresol = interfaces[if_id] if if_id < len(interfaces) else interfaces[0]
+                yield (((ts_high << 32) | ts_low) * tsresol, linktype, body[20:20 + caplen])
+            elif block_type == PCAPNG_SPB and interfaces:
+                (orig_len,) = struct.unpack(e + "L", body[:4])
+                linktype, _ = interfaces[0]
+                yield (0.0, linktype, body[4:4 + min(orig_len, len(body) - 4)])
+
+            pos += block_length
+
+    def _read_idb(self, body, e):
+        """read link type and timestamp resolution of an interface"""
+        (linktype,) = struct.unpack(e + "H", body[:2])
+        tsresol = 1e-6
+        pos = 8
+        while pos + 4 <= len(body):
+            (code, length) = struct.unpack(e + "HH", body[pos:pos + 4])
+            if code == 0:
+                break
+            if code == PCAPNG_OPT_TSRESOL and length >= 1:
+                value = body[pos + 4]
+                tsresol = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+            pos += 4 + ((length + 3) & ~3)
+        return (linktype, tsresol)
+
+    def chunks(self, size):
+        """split the capture in (start, end, interfaces) ranges aligned on records
+
+        interfaces are the pcapng interfaces declared before the start of the range.
+        """
+        data = self.data
+        e = self.endian
+        pos = self.first_record()
+        start = pos
+        interfaces = []
+        start_interfaces = []
+        while pos < len(data):
+            if self.pcapng:
+                if pos + 12 > len(data):
+                    break
+                (block_type, length) = struct.unpack(e + "LL", data[pos:pos + 8])
+                if length < 12:
+                    break
+                if block_type == PCAPNG_SHB:
+                    interfaces = []
+                elif block_type == PCAPNG_IDB:
+                    interfaces.append(self._read_idb(data[pos + 8:pos + length - 4], e))
+            else:
+                if pos + 16 > len(data):
+                    break
+                (caplen,) = struct.unpack(e + "L", data[pos + 8:pos + 12])
+                length = 16 + caplen
+            pos += length
+            if pos - start >= size:
+                yield (start, pos, start_interfaces)
+                start = pos
+                start_interfaces = list(interfaces)
+        if pos > start:
+            yield (start, min(pos, len(data)), start_interfaces)
+
+    def packets(self, start=None, end=None, interfaces=None):
+        """yield udp datagrams and tcp segments"""
+        for timestamp, linktype, frame in self.records(start, end, interfaces):
+            parsed = parse_frame(linktype, frame)
+            if parsed is None:
+                continue
+            proto, src, dst, payload, tcp = parsed
+            yield Packet(timestamp, proto, src, dst, payload), tcp
+
+    def messages(self, raw=False, start=None, end=None, interfaces=None, max_streams=1024):
+        """yield (packet, message) for each stun message found
+
+        udp datagrams are checked and decoded one by one, tcp streams are
+        reassembled and fed to a codec per direction. With raw, the message is
+        the memoryview of the payload, not decoded, and tcp is ignored.
+        """
+        codec = stun.Codec()
+        streams = {}
+        for pkt, tcp in self.packets(start, end, interfaces):
+            if tcp is None:
+                if not is_stun(pkt.payload):
+                    continue
+                if raw:
+                    yield pkt, pkt.payload
+                    continue
+                codec.buf = bytes(pkt.payload)
+                try:
+                    msg = codec.decode()
+                except Exception:
+                    continue
+                if msg is not None:
+                    yield pkt, msg
+                continue
+
+            if raw:
+                continue
+
+            seq, flags = tcp
+            key = (pkt.src, pkt.dst)
+            stream = streams.get(key)
+            if stream is None:
+                if len(streams) >= max_streams:
+                    streams.pop(next(iter(streams)))
+                stream = streams[key] = TcpStream()
+
+            for msg in stream.feed(seq, flags, pkt.payload):
+                yield pkt, msg
+
+            if flags & (TCP_FIN | TCP_RST):
+                streams.pop(key, None)
+
+def messages(path, raw=False):
+    """stream the stun messages of a pcap or pcapng file in constant memory"""
+    with PcapReader(path) as reader:
+        yield from reader.messages(raw=raw)
+
+def _read_chunk(args):
+    """worker: decode the messages of one chunk"""
+    path, start, end, interfaces, raw = args
+    ret = []
+    with PcapReader(path) as reader:
+        for pkt, msg in reader.messages(raw=raw, start=start, end=end, interfaces=interfaces):
+            pkt.payload = bytes(pkt.payload)
+            ret.append((pkt, bytes(msg) if raw else msg))
+    return ret
+
+def messages_parallel(path, processes=None, chunk_size=4*1024*1024, raw=False, prefetch=2):
+    """shard a large capture across a process pool, messages are yield in file order
+
+    tcp streams are reassembled inside each chunk only. At most prefetch
+    chunks per process are decoded ahead of the consumer, so the memory used
+    does not grow with the size of the capture.
+    """
+    import multiprocessing
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    # the chunks are found while the previous ones are decoded, not all upfront
+    with PcapReader(path) as reader, multiprocessing.Pool(processes=processes) as pool:
+        running = collections.deque()
+        for start, end, interfaces in reader.chunks(chunk_size):
+            if len(running) >= processes * prefetch:
+                yield from running.popleft().get()
+            task = (os.fspath(path), start, end, interfaces, raw)
+            running.append(pool.apply_async(_read_chunk, (task,)))
+        while running:
+            yield from running.popleft().get()
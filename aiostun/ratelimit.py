@@ -0,0 +1,86 @@
+import os
+import time
+import array
+import socket
+
+from aiostun import attribute
+from aiostun import metrics as stun_metrics
+
+# verdicts of the rate limiter
+ALLOW = 0
+DROP = 1
+SLIP = 2
+
+class RateLimiter:
+    def __init__(self, rate=20, burst=40, size=65536, slip=2,
+                 ipv4_prefix=24, ipv6_prefix=56, metrics=None):
+        """response rate limiting with a fixed-size table of token buckets
+
+        sources are grouped by prefix and hashed in a table of size buckets,
+        so the memory does not depend on the number of addresses seen.
+        One limited response out of slip is slipped instead of dropped,
+        slip=0 drops all of them.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.slip = slip
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self._metrics = metrics
+
+        # round the size to a power of two to index with a mask
+        self.size = 1 << max(size - 1, 1).bit_length()
+        self._mask = self.size - 1
+        self._tokens = array.array("d", [burst]) * self.size
+        self._last = array.array("d", [0.0]) * self.size
+        # salt the hash so that an attacker can not target a bucket
+        self._salt = os.urandom(8)
+        self._limited = 0
+
+        self.allowed = 0
+        self.dropped = 0
+        self.slipped = 0
+
+    def prefix(self, ip):
+        """source prefix of the ip, ipv4-mapped addresses are grouped like ipv4"""
+        ip = attribute.unmap_ip(ip)
+        if ":" not in ip:
+            if self.ipv4_prefix == 24:
+                return ip.rpartition(".")[0]
+            packed, bits = socket.inet_aton(ip), self.ipv4_prefix
+        else:
+            packed, bits = socket.inet_pton(socket.AF_INET6, ip.partition("%")[0]), self.ipv6_prefix
+
+        n, rem = divmod(bits, 8)
+        if not rem:
+            return packed[:n]
+        return packed[:n] + bytes([packed[n] & (0xFF << (8 - rem)) & 0xFF])
+
+    def check(self, ip, now=None):
+        """return ALLOW, DROP or SLIP for a response to the ip"""
+        if now is None:
+            now = time.monotonic()
+        i = hash((self._salt, self.prefix(ip))) & self._mask
+
+        tokens = self._tokens[i] + (now - self._last[i]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self._last[i] = now
+
+        if tokens >= 1:
+            self._tokens[i] = tokens - 1
+            self.allowed += 1
+            return ALLOW
+
+        self._tokens[i] = tokens
+        self._limited += 1
+        if self.slip and self._limited % self.slip == 0:
+            self.slipped += 1
+            if self._metrics is not None:
+                self._metrics.inc(stun_metrics.RRL_SLIPPED)
+            return SLIP
+
+        self.dropped += 1
+        if self._metrics is not None:
+            self._metrics.inc(stun_metrics.RRL_DROPPED)
+        return DROP
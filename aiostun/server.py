@@ -0,0 +1,217 @@
+import time
+import struct
+import asyncio
+import socket
+
+from aiostun import constants
+from aiostun import stun
+from aiostun import attribute
+from aiostun import ratelimit
+from aiostun import metrics as stun_metrics
+
+
+class ServerProtocol:
+    def __init__(self, server):
+        """init"""
+        self._server = server
+        self._transport = None
+
+    def connection_made(self, transport):
+        """on connection made"""
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        """on udp datagram received"""
+        resp = self._server.handle(data, addr, asyncio.get_running_loop().time())
+        if resp is not None:
+            self._transport.sendto(resp, addr)
+
+    def error_received(self, exc):
+        """on error"""
+        self._server.error_received(exc)
+
+    def connection_lost(self, exc):
+        """on connection lost"""
+        pass
+
+
+class Server:
+    def __init__(
+        self,
+        host="0.0.0.0",
+        port=3478,
+        family=constants.FAMILY_IP4,
+        software=None,
+        rate_limiter=None,
+        metrics=None,
+        alternates=None,
+        max_rate=None,
+        max_queue=None,
+        network=None,
+    ):
+        """init
+
+        alternates is the list of (ip, port) of the peers of the fleet. Above
+        max_rate requests per second, or max_queue bytes waiting in the send
+        buffer, requests are answered with 300 Try Alternate pointing at the
+        least loaded peer, as reported with set_peer_load.
+        """
+        self._host = host
+        self._port = port
+        self._family = family
+        self._software = software
+        self._rate_limiter = rate_limiter
+        self._metrics = metrics
+        self._stun_codec = stun.Codec()
+        self._transport = None
+        self._network = network
+
+        # load of the peers, in requests per second
+        self._peers = {}
+        for peer in alternates or []:
+            self._peers[tuple(peer[:2])] = 0.0
+        self._max_rate = max_rate
+        self._max_queue = max_queue
+        # requests of the current one second window, and rate of the previous one
+        self._window = 0.0
+        self._count = 0
+        self.rate = 0.0
+        self.redirected = 0
+
+    async def __aenter__(self):
+        """aenter"""
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """aexit"""
+        self.close()
+
+    async def start(self):
+        """listen on udp"""
+        endpoints = asyncio.get_running_loop() if self._network is None else self._network
+        family = socket.AF_INET6 if self._family == constants.FAMILY_IP6 else socket.AF_INET
+        self._transport, _ = await endpoints.create_datagram_endpoint(
+            lambda: ServerProtocol(self), local_addr=(self._host, self._port), family=family
+        )
+        return self
+
+    def close(self):
+        """close transport"""
+        if self._transport is not None:
+            self._transport.close()
+
+    def get_local_addr(self):
+        """get local ip and port"""
+        if self._transport is None:
+            return None
+        return self._transport.get_extra_info("sockname")
+
+    def set_peer_load(self, ip, port, load):
+        """update the load of a peer, in requests per second like Server.rate"""
+        self._peers[(ip, port)] = load
+
+    def _count_request(self, now):
+        """update the request rate with one second windows"""
+        if now - self._window >= 1.0:
+            self.rate = self._count / (now - self._window) if self._count else 0.0
+            self._window = now
+            self._count = 0
+        self._count += 1
+
+    def _overloaded(self):
+        """true when the rate or the send queue is above the limits"""
+        if self._max_rate is not None and max(self._count, self.rate) > self._max_rate:
+            return True
+        if self._max_queue is not None and self._transport is not None:
+            return self._transport.get_write_buffer_size() > self._max_queue
+        return False
+
+    def alternate(self, ip):
+        """least loaded peer of the family of the ip, None if all peers are busier"""
+        ip6 = ":" in ip
+        load = max(self._count, self.rate)
+        best = None
+        for peer, peer_load in self._peers.items():
+            if (":" in attribute.unmap_ip(peer[0])) != ip6 or peer_load >= load:
+                continue
+            if best is None or peer_load < self._peers[best]:
+                best = peer
+        return best
+
+    def error_received(self, exc):
+        """on transport error"""
+        if self._metrics is not None:
+            self._metrics.inc(stun_metrics.TRANSPORT_ERRORS)
+
+    def handle(self, data, addr, now=None):
+        """answer to a binding request, return the response to send or None"""
+        if now is None:
+            now = time.monotonic()
+        # cheap checks of the header, before any decoding
+        if len(data) < constants.STUN_HEADER_SIZE or data[0] & 0xC0:
+            return None
+        (stuntype, stunlength) = struct.unpack_from("!HH", data)
+        if stunlength % 4 or stunlength + constants.STUN_HEADER_SIZE != len(data):
+            return None
+        stunclass = ((stuntype & 0x0010) >> 4) | ((stuntype & 0x0100) >> 7)
+        stunmethod = (stuntype & 0x000F) | ((stuntype & 0x00E0) >> 1) | ((stuntype & 0x3E00) >> 2)
+        if stunclass != constants.CLASS_REQUEST or stunmethod != constants.METHOD_BINDING:
+            return None
+
+        if self._metrics is not None:
+            self._metrics.inc(stun_metrics.REQUESTS_RECEIVED)
+
+        # ipv4 clients of a dual-stack socket are seen as ::ffff:a.b.c.d
+        client = (attribute.unmap_ip(addr[0]), addr[1])
+
+        # rate limit the responses per source prefix
+        verdict = ratelimit.ALLOW
+        if self._rate_limiter is not None:
+            verdict = self._rate_limiter.check(client[0], now)
+            if verdict == ratelimit.DROP:
+                return None
+
+        (magic_cookie,) = struct.unpack_from("!L", data, 4)
+        if verdict == ratelimit.SLIP:
+            err = attribute.AttrErrorCode().set_error(508)
+            return self.response(data, magic_cookie, constants.CLASS_ERROR, [err])
+
+        # shed the load to a peer instead of dropping requests
+        if self._peers:
+            self._count_request(now)
+            peer = self.alternate(client[0]) if self._overloaded() else None
+            if peer is not None:
+                self.redirected += 1
+                if self._metrics is not None:
+                    self._metrics.inc(stun_metrics.REDIRECTS_SENT)
+                return self.response(data, magic_cookie, constants.CLASS_ERROR, self.alternate_attrs(peer))
+
+        return self.response(data, magic_cookie, constants.CLASS_SUCCESS, self.mapped_attrs(data, magic_cookie, client))
+
+    def mapped_attrs(self, data, magic_cookie, addr):
+        """attributes of a binding success response"""
+        family = constants.FAMILY_IP6 if ":" in addr[0] else constants.FAMILY_IP4
+        if magic_cookie == constants.MAGIC_COOKIE:
+            attrs = [ attribute.AttrXorMappedAddr().set_address(family, addr[0], addr[1], data[8:20]) ]
+        else:
+            attrs = [ attribute.AttrMappedAddr().set_address(family, addr[0], addr[1]) ]
+        if self._software is not None:
+            attrs.append(attribute.AttrSoftware(self._software))
+        return attrs
+
+    def alternate_attrs(self, peer):
+        """attributes of a 300 try alternate response"""
+        peer = (attribute.unmap_ip(peer[0]), peer[1])
+        family = constants.FAMILY_IP6 if ":" in peer[0] else constants.FAMILY_IP4
+        return [ attribute.AttrErrorCode().set_error(300, "Try Alternate"),
+                 attribute.AttrAlternateServer().set_address(family, peer[0], peer[1]) ]
+
+    def response(self, data, magic_cookie, msgclass, attrs):
+        """encode a response with the transaction id of the request"""
+        if magic_cookie == constants.MAGIC_COOKIE:
+            resp = stun.Message(msgclass, constants.METHOD_BINDING, attrs)
+            resp.transaction_id = data[8:20]
+        else:
+            resp = stun.ClassicMessage(msgclass, constants.METHOD_BINDING, attrs)
+            resp.transaction_id = data[4:20]
+        return self._stun_codec.encode(resp)
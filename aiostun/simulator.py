@@ -0,0 +1,317 @@
+import random
+import struct
+import asyncio
+import selectors
+
+from aiostun import constants
+from aiostun import attribute
+from aiostun import server as stun_server
+
+# nat types, https://www.rfc-editor.org/rfc/rfc3489#section-5
+NAT_FULL_CONE = "full-cone"
+NAT_RESTRICTED = "restricted"
+NAT_PORT_RESTRICTED = "port-restricted"
+NAT_SYMMETRIC = "symmetric"
+
+# first port given to the sockets of the simulated hosts
+EPHEMERAL_PORT = 50000
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    def __init__(self, loop):
+        """selector without io, waiting only moves the virtual clock"""
+        self._loop = loop
+        self._map = {}
+
+    def register(self, fileobj, events, data=None):
+        """register"""
+        key = selectors.SelectorKey(fileobj, fileobj if isinstance(fileobj, int) else fileobj.fileno(),
+                                    events, data)
+        self._map[fileobj] = key
+        return key
+
+    def unregister(self, fileobj):
+        """unregister"""
+        return self._map.pop(fileobj)
+
+    def select(self, timeout=None):
+        """jump to the next timer instead of sleeping"""
+        if timeout is None:
+            raise RuntimeError("Simulation deadlock, nothing is scheduled")
+        if timeout > 0:
+            self._loop.clock += timeout
+        return []
+
+    def get_map(self):
+        """get map"""
+        return self._map
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        """event loop with a virtual clock, timers fire as soon as nothing else is ready
+
+        there is no real io, only the simulated network can be used
+        """
+        self.clock = 0.0
+        super().__init__(selector=_VirtualSelector(self))
+
+    def time(self):
+        """virtual time"""
+        return self.clock
+
+def run(coro):
+    """run the coroutine in a new virtual loop, like asyncio.run"""
+    loop = VirtualLoop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class NATBox:
+    def __init__(self, public_ip, nat_type=NAT_PORT_RESTRICTED, first_port=40000):
+        """nat with the mapping and filtering behavior of its type"""
+        self.public_ip = public_ip
+        self.nat_type = nat_type
+        self._next_port = first_port
+        self._mappings = {}
+        # private address and allowed remotes of each public port
+        self._ports = {}
+
+    def outbound(self, src, dst):
+        """public address of a packet sent from src to dst"""
+        key = src if self.nat_type != NAT_SYMMETRIC else (src, dst)
+        if key not in self._mappings:
+            self._mappings[key] = self._next_port
+            self._ports[self._next_port] = (src, set())
+            self._next_port += 1
+        port = self._mappings[key]
+        self._ports[port][1].add(dst)
+        return (self.public_ip, port)
+
+    def inbound(self, port, src):
+        """private address of a packet received on the public port, None if filtered"""
+        if port not in self._ports:
+            return None
+        (private, remotes) = self._ports[port]
+        if self.nat_type == NAT_FULL_CONE:
+            return private
+        if self.nat_type == NAT_RESTRICTED:
+            return private if src[0] in [ r[0] for r in remotes ] else None
+        return private if src in remotes else None
+
+
+class Network:
+    def __init__(self, latency=0.01, jitter=0.0, loss=0.0, reorder=0.0, seed=0):
+        """udp network with latency, jitter, loss and reordering
+
+        the randomness comes from a generator seeded with seed, so a
+        simulation always gives the same result. A reordered packet is
+        delayed by one more latency.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self._random = random.Random(seed)
+        self._endpoints = {}
+        self._nats = {}
+        self.sent = 0
+        self.lost = 0
+
+    def add_nat(self, public_ip, nat_type=NAT_PORT_RESTRICTED, first_port=40000):
+        """add a nat, the hosts behind it are created with host(ip, nat)"""
+        nat = NATBox(public_ip, nat_type, first_port)
+        self._nats[public_ip] = nat
+        return nat
+
+    def host(self, ip, nat=None):
+        """host with the ip, behind the nat if any"""
+        return Host(self, ip, nat)
+
+    def delay(self):
+        """delay of the next packet, None if lost"""
+        if self.loss and self._random.random() < self.loss:
+            return None
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(-self.jitter, self.jitter)
+        if self.reorder and self._random.random() < self.reorder:
+            delay += self.latency
+        return max(delay, 0.0)
+
+    def send(self, data, src, dst, nat=None):
+        """send a datagram, through the nat of the sender and the one of the receiver"""
+        self.sent += 1
+        if nat is not None:
+            src = nat.outbound(src, dst)
+
+        delay = self.delay()
+        if delay is None:
+            self.lost += 1
+            return
+        asyncio.get_running_loop().call_later(delay, self._deliver, bytes(data), src, dst)
+
+    def _deliver(self, data, src, dst):
+        """deliver the datagram to the endpoint bound on dst"""
+        if dst[0] in self._nats:
+            dst = self._nats[dst[0]].inbound(dst[1], src)
+            if dst is None:
+                return
+        transport = self._endpoints.get(dst)
+        if transport is not None:
+            transport.receive(data, src)
+
+
+class Host:
+    def __init__(self, network, ip, nat=None):
+        """simulated host, use it as the network of aiostun.Client or aiostun.Server"""
+        self.network = network
+        self.ip = ip
+        self.nat = nat
+        self._next_port = EPHEMERAL_PORT
+
+    async def create_datagram_endpoint(self, protocol_factory, local_addr=None, remote_addr=None, **kwargs):
+        """same as loop.create_datagram_endpoint on the simulated network"""
+        port = local_addr[1] if local_addr else 0
+        if not port:
+            while (self.ip, self._next_port) in self.network._endpoints:
+                self._next_port += 1
+            port = self._next_port
+        sockname = (self.ip, port)
+        if sockname in self.network._endpoints:
+            raise OSError("Address already in use")
+
+        protocol = protocol_factory()
+        transport = Transport(self, sockname, remote_addr, protocol)
+        self.network._endpoints[sockname] = transport
+        protocol.connection_made(transport)
+        return transport, protocol
+
+
+class Transport(asyncio.DatagramTransport):
+    def __init__(self, host, sockname, peername, protocol):
+        """udp socket of a simulated host"""
+        super().__init__()
+        self._host = host
+        self._sockname = sockname
+        self._peername = tuple(peername[:2]) if peername else None
+        self._protocol = protocol
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        """sockname and peername only, there is no socket"""
+        if name == "sockname":
+            return self._sockname
+        if name == "peername":
+            return self._peername
+        return default
+
+    def sendto(self, data, addr=None):
+        """send a datagram"""
+        if self._closing:
+            return
+        if addr is None:
+            addr = self._peername
+        elif self._peername is not None and tuple(addr[:2]) != self._peername:
+            raise ValueError("Invalid address: must be None or %s" % (self._peername,))
+        self._host.network.send(data, self._sockname, tuple(addr[:2]), self._host.nat)
+
+    def receive(self, data, addr):
+        """datagram from the network"""
+        if self._closing:
+            return
+        if self._peername is not None and addr != self._peername:
+            return
+        self._protocol.datagram_received(data, addr)
+
+    def get_write_buffer_size(self):
+        """nothing is buffered"""
+        return 0
+
+    def is_closing(self):
+        """is closing"""
+        return self._closing
+
+    def close(self):
+        """close"""
+        if self._closing:
+            return
+        self._closing = True
+        self._host.network._endpoints.pop(self._sockname, None)
+        asyncio.get_running_loop().call_soon(self._protocol.connection_lost, None)
+
+    def abort(self):
+        """abort"""
+        self.close()
+
+
+class ClassicServer(stun_server.Server):
+    def __init__(self, network, ip, alt_ip, port=3478, alt_port=3479, **kwargs):
+        """rfc3489 server on two ips and two ports, answering from the address asked by CHANGE-REQUEST"""
+        super().__init__(host=ip, port=port, **kwargs)
+        self._network = network
+        self._ips = (ip, alt_ip)
+        self._ports = (port, alt_port)
+        self._transports = {}
+
+    async def start(self):
+        """listen on the four addresses"""
+        for ip in self._ips:
+            host = self._network.host(ip)
+            for port in self._ports:
+                transport, _ = await host.create_datagram_endpoint(
+                    lambda: _ClassicProtocol(self, (ip, port)), local_addr=(ip, port))
+                self._transports[(ip, port)] = transport
+        self._transport = self._transports[(self._ips[0], self._ports[0])]
+        return self
+
+    def close(self):
+        """close the four transports"""
+        for transport in self._transports.values():
+            transport.close()
+
+    def mapped_attrs(self, data, magic_cookie, addr):
+        """mapped address and changed address"""
+        attrs = super().mapped_attrs(data, magic_cookie, addr)
+        changed = attribute.AttrChangedAddress().set_address(constants.FAMILY_IP4, self._ips[1], self._ports[1])
+        return attrs + [ changed ]
+
+    def reply(self, data, local, addr):
+        """answer from the address asked by the change request"""
+        resp = self.handle(data, addr, asyncio.get_running_loop().time())
+        if resp is None:
+            return
+        (change_ip, change_port) = change_flags(data)
+        ip = self._ips[(self._ips.index(local[0]) + change_ip) % 2]
+        port = self._ports[(self._ports.index(local[1]) + change_port) % 2]
+        self._transports[(ip, port)].sendto(resp, addr)
+
+def change_flags(data):
+    """change ip and change port flags of the CHANGE-REQUEST attribute of a request"""
+    offset = constants.STUN_HEADER_SIZE
+    while offset + 4 <= len(data):
+        (attr_type, attr_length) = struct.unpack_from("!HH", data, offset)
+        if attr_type == constants.ATTR_CHANGE_REQUEST and attr_length == 4:
+            (flags,) = struct.unpack_from("!L", data, offset + 4)
+            return (int(bool(flags & 4)), int(bool(flags & 2)))
+        offset += 4 + attr_length + (-attr_length % 4)
+    return (0, 0)
+
+class _ClassicProtocol:
+    def __init__(self, server, local):
+        """init"""
+        self._server = server
+        self._local = local
+
+    def connection_made(self, transport):
+        """on connection made"""
+        pass
+
+    def datagram_received(self, data, addr):
+        """on udp datagram received"""
+        self._server.reply(data, self._local, addr)
+
+    def connection_lost(self, exc):
+        """on connection lost"""
+        pass
@@ -1,16 +1,25 @@
+import os
+import time
 import struct
 import asyncio
-import string
-import random
 
 from aiostun import constants
 from aiostun import attribute
+from aiostun import metrics as stun_metrics
+from aiostun import tracing
+
+ID_CHARS = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# random bytes from this value are dropped, 256 is not a multiple of 52
+# and the first chars would be more likely
+ID_LIMIT = 256 - 256 % len(ID_CHARS)
 
 def gen_id(length=12):
-    """generate random id"""
-    chars = string.ascii_lowercase
-    chars += string.ascii_uppercase
-    return b''.join([random.choice(chars).encode() for i in range(length)])
+    """generate random id, each char is uniformly distributed"""
+    ret = bytearray()
+    while len(ret) < length:
+        ret.extend(ID_CHARS[b % len(ID_CHARS)] for b in os.urandom(length) if b < ID_LIMIT)
+    return bytes(ret[:length])
 
 class Message(object):
     def __init__(self, msgclass, msgmethod, attrs):
@@ -41,7 +50,7 @@ class Message(object):
                 return attr
         return None
 
-    def decode_attrs(self, attrs):
+    def decode_attrs(self, attrs, metrics=None):
         """decode all attributes"""
         for attr in attrs:
             # decode the value 
@@ -69,6 +78,10 @@ class Message(object):
                 attr_obj = attribute.AttrChangedAddress()
                 attr_obj.decode(value=attr["value"])
 
+            elif attr["type"] in [ constants.ATTR_ALTERNATE_SERVER ]:
+                attr_obj = attribute.AttrAlternateServer()
+                attr_obj.decode(value=attr["value"])
+
             elif attr["type"] in [ constants.ATTR_SOFTWARE ]:
                 attr_obj = attribute.AttrSoftware(attr["value"])
 
@@ -86,7 +99,8 @@ class Message(object):
                 attr_obj = attribute.AttrRealm(attr["value"])
 
             else:
-                print(attr["type"], attr["value"])
+                if metrics is not None:
+                    metrics.inc(stun_metrics.UNKNOWN_ATTRIBUTES)
                 attr_obj = attribute.Attribute(attr["type"])
                 attr_obj.decode(value=attr["value"])
 
@@ -121,72 +135,241 @@ class ClassicMessage(Message):
         self.transaction_id = gen_id(length=16)
 
 class Codec:
-    def __init__(self):
-        """init"""
+    def __init__(self, metrics=None, tracer=None, maxsize=64, overflow=constants.QUEUE_DROP_OLDEST,
+                 strict=False, max_size=constants.STUN_MAX_SIZE, max_attributes=constants.STUN_MAX_ATTRIBUTES):
+        """init
+
+        malformed frames are dropped and counted in rejected. With strict,
+        messages without the magic cookie (classic stun) are rejected too.
+        """
         self.buf = b""
-        self._queue = asyncio.Queue(0)
+        self.strict = strict
+        self.max_size = max_size
+        self.max_attributes = max_attributes
+        self.rejected = 0
+        self.transport = None
+        self._queue = asyncio.Queue(maxsize)
+        self._overflow = overflow
+        self._paused = False
+        self._metrics = metrics
+        self._tracer = tracer
+        # arrival of the first byte of the frame at the head of the buffer,
+        # and of the last data fed, for the first_byte event
+        self._first_byte = None
+        self._received_at = None
+        # transaction ids of the requests waiting for a response, once a
+        # request has been registered the unknown responses are stale
+        self.pending = {}
+        self._tracking = False
+        self.max_pending = 1024
+        self._on_message = None
+        self._batch = None
+
+    def set_on_message(self, callback, batch=False):
+        """deliver messages which are not responses to a pending request to the callback"""
+        self._on_message = callback
+        self._batch = [] if callback is not None and batch else None
+
+    def add_pending(self, transaction_id):
+        """register the transaction id of a request"""
+        self._tracking = True
+        self.pending[transaction_id] = None
+        if len(self.pending) > self.max_pending:
+            self.pending.pop(next(iter(self.pending)))
 
     def feed_data(self, data):
         """append data to the buffer"""
+        if self._tracer is not None:
+            self._received_at = time.monotonic()
+            if not self.buf:
+                self._first_byte = self._received_at
+
         self.buf = b''.join([self.buf, data])
 
-        resp = self.decode()
-        if resp is None: return
+        if self._metrics is not None:
+            self._metrics.inc(stun_metrics.BYTES_IN, len(data))
+        self._decode_all()
+
+    def feed_datagram(self, data):
+        """decode an udp datagram on its own, its size must be the length of its header
+
+        a datagram is never completed by the next one, a bogus length would
+        otherwise hold all the following datagrams in the buffer
+        """
+        if self._tracer is not None:
+            self._received_at = self._first_byte = time.monotonic()
+        if self._metrics is not None:
+            self._metrics.inc(stun_metrics.BYTES_IN, len(data))
+
+        if len(data) < constants.STUN_HEADER_SIZE or \
+                struct.unpack_from("!H", data, 2)[0] + constants.STUN_HEADER_SIZE != len(data):
+            self._reject()
+            return
+
+        self.buf = bytes(data)
+        try:
+            resp = self.decode()
+        finally:
+            self.buf = b""
+        if resp is not None:
+            self._put(resp)
+
+    def _decode_all(self):
+        """decode all complete messages from the buffer, a tcp segment can carry several of them"""
+        while True:
+            # backpressure, keep the data in the buffer until the queue is drained
+            if self._overflow == constants.QUEUE_PAUSE_READING and self.transport is not None:
+                if self._queue.full():
+                    if not self._paused:
+                        self._paused = True
+                        self.transport.pause_reading()
+                    return
+
+            resp = self.decode()
+            if resp is None: return
+
+            self._put(resp)
+
+    def _put(self, resp):
+        """add a decoded message to the queue according to the overflow policy"""
+        if self._on_message is not None and resp.transaction_id not in self.pending:
+            self._deliver(resp)
+            return
+
+        # a late response of a timed out request must not be read by the next one
+        if self._tracking and resp.transaction_id not in self.pending:
+            if resp.msgclass in [constants.CLASS_SUCCESS, constants.CLASS_ERROR]:
+                if self._metrics is not None:
+                    self._metrics.inc(stun_metrics.RESPONSES_UNMATCHED)
+                return
+        self.pending.pop(resp.transaction_id, None)
+
+        if self._queue.full():
+            if self._metrics is not None:
+                self._metrics.inc(stun_metrics.QUEUE_DROPPED)
+            if self._overflow != constants.QUEUE_DROP_OLDEST:
+                return
+            self._queue.get_nowait()
 
         self._queue.put_nowait(resp)
+        if self._metrics is not None:
+            self._metrics.set(stun_metrics.QUEUE_DEPTH, self._queue.qsize())
+
+    def _deliver(self, resp):
+        """call the message callback, now or once per loop iteration in batch mode"""
+        if self._batch is None:
+            self._on_message(resp)
+            return
+        if not self._batch:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._batch.append(resp)
+
+    def _flush(self):
+        """deliver the pending batch"""
+        if not self._batch or self._on_message is None:
+            return
+        batch, self._batch = self._batch, []
+        self._on_message(batch)
+
+    def connection_lost(self):
+        """signal the end of the stream to the message callback"""
+        if self._on_message is not None:
+            self._flush()
+            self._on_message(None)
+
+    async def get(self):
+        """wait for the next decoded message"""
+        resp = await self._queue.get()
+        if self._metrics is not None:
+            self._metrics.set(stun_metrics.QUEUE_DEPTH, self._queue.qsize())
+
+        # resume reading once the queue is half empty
+        if self._paused and self._queue.qsize() <= self._queue.maxsize // 2:
+            self._paused = False
+            self.transport.resume_reading()
+            self._decode_all()
+        return resp
+
+    def _reject(self, length=None):
+        """drop a bad frame, or the whole buffer when its end is unknown"""
+        self.buf = b"" if length is None else self.buf[length:]
+        self.rejected += 1
+        if self._metrics is not None:
+            self._metrics.inc(stun_metrics.DECODE_ERRORS)
 
     def decode(self):
-        """decode data from buffer"""
-        if len(self.buf) < constants.STUN_HEADER_SIZE:
-            return None
-
-        # enough data to decode header
-        (stunlength,) = struct.unpack("!H", self.buf[2:4])
-
-        if len(self.buf) < stunlength + constants.STUN_HEADER_SIZE:
-            return None
-
-        # decode header
-        (stuntype, stunlength) = struct.unpack("!HH", self.buf[:4])
-
-        # remote packet from buffer
-        pl = self.buf[:stunlength+constants.STUN_HEADER_SIZE]
-        self.buf = self.buf[stunlength+constants.STUN_HEADER_SIZE:]
+        """decode data from buffer, bad frames are rejected and skipped"""
+        while len(self.buf) >= constants.STUN_HEADER_SIZE:
+            # cheap checks of the header first, garbage costs a few comparisons
+            (stuntype, stunlength, magic_cookie) = struct.unpack_from("!HHL", self.buf)
+            if stuntype & 0xC000 or stunlength % 4 or stunlength > self.max_size:
+                self._reject()
+                return None
+            if self.strict and magic_cookie != constants.MAGIC_COOKIE:
+                self._reject()
+                return None
+
+            length = stunlength + constants.STUN_HEADER_SIZE
+            if len(self.buf) < length:
+                return None
+
+            # the transaction id is known once the header is parsed
+            first_byte = self._first_byte
+            self._first_byte = self._received_at
+            if self._tracer is not None and first_byte is not None:
+                tid = self.buf[8:20] if magic_cookie == constants.MAGIC_COOKIE else self.buf[4:20]
+                self._tracer(tracing.EVENT_FIRST_BYTE, tid, first_byte)
+
+            try:
+                rsp = self._decode_frame(self.buf[:length], stuntype, stunlength, magic_cookie)
+            except (ValueError, KeyError, IndexError, struct.error):
+                rsp = None
+            if rsp is None:
+                self._reject(length)
+                continue
+
+            # remote packet from buffer
+            self.buf = self.buf[length:]
+            if self._tracer is not None:
+                self._tracer(tracing.EVENT_DECODED, rsp.transaction_id, time.monotonic())
+            return rsp
+        return None
 
+    def _decode_frame(self, pl, stuntype, stunlength, magic_cookie):
+        """decode a complete frame, None if the attributes are malformed"""
         # decode class and method
         stunclass = ((stuntype & 0x0010) >> 4) | ((stuntype & 0x0100) >> 7)
         stunmethod = (stuntype & 0x000F) | ((stuntype & 0x00E0) >> 1)  | ((stuntype & 0x3E00) >> 2)
 
         # read magic cookie and transactionid
-        (magic_cookie,) = struct.unpack("!L", pl[4:8])
         if magic_cookie != constants.MAGIC_COOKIE:
             magic_cookie = 0
-            (transaction_id,) = struct.unpack("!16s", pl[4:20])
+            transaction_id = pl[4:20]
         else:
-            (transaction_id,) = struct.unpack("!12s", pl[8:20])
+            transaction_id = pl[8:20]
 
-        # finally, decode attributes
-        pl = pl[20:]
+        # finally, decode attributes, bounded in number and by the frame
         attrs = []
-        while len(pl) >= 4:
-            # read attribute
-            (attr_type, attr_length,) = struct.unpack("!HH", pl[:4])
+        offset = constants.STUN_HEADER_SIZE
+        while offset < len(pl):
+            if len(attrs) == self.max_attributes or offset + 4 > len(pl):
+                return None
+            (attr_type, attr_length,) = struct.unpack_from("!HH", pl, offset)
 
             # padding ? always a multiple of 4 bytes
-            pad_mod = 4-((attr_length+4) % 4)
-            pad_length = 0 if pad_mod == 4 else pad_mod
-
-            attrs.append( {"type": attr_type, "value": pl[4:4+attr_length]} )
+            end = offset + 4 + attr_length
+            if end > len(pl):
+                return None
+            attrs.append( {"type": attr_type, "value": pl[offset+4:end]} )
 
             # data remaining for next attributes
-            pl = pl[4+attr_length+pad_length:]
+            offset = end + (-attr_length % 4)
 
         rsp = Message(stunclass, stunmethod, [])
         rsp.msglength = stunlength
         rsp.magic_cookie = magic_cookie
         rsp.transaction_id = transaction_id
-        rsp.decode_attrs(attrs)
-
+        rsp.decode_attrs(attrs, metrics=self._metrics)
         return rsp
 
     def encode(self, m):
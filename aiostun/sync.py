@@ -0,0 +1,145 @@
+import asyncio
+import threading
+
+from aiostun import client
+from aiostun import nat
+
+_lock = threading.Lock()
+_loop = None
+_thread = None
+
+def get_loop():
+    """shared event loop running in a background thread, started on first use"""
+    global _loop, _thread
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_loop.run_forever, name="aiostun-loop", daemon=True)
+            _thread.start()
+        return _loop
+
+def run(coro, timeout=None):
+    """run the coroutine in the shared loop and wait for its result"""
+    loop = get_loop()
+    if threading.current_thread() is _thread:
+        coro.close()
+        raise RuntimeError("Blocking call from the aiostun event loop")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+def shutdown():
+    """stop the shared loop, RuntimeError from the loop thread which could not be joined"""
+    global _loop, _thread
+    if threading.current_thread() is _thread:
+        raise RuntimeError("Shutdown from the aiostun event loop")
+    with _lock:
+        if _loop is None:
+            return
+        _loop.call_soon_threadsafe(_loop.stop)
+        _thread.join()
+        _loop.close()
+        _loop = None
+        _thread = None
+
+
+class SyncClient:
+    def __init__(self, host, port=3478, pool_size=4, **kwargs):
+        """blocking client, the connected clients are pooled and reused across calls
+
+        the other arguments are the ones of aiostun.Client. A call takes an
+        idle client from the pool, so up to pool_size requests run at once
+        whatever the number of calling threads.
+        """
+        self._kwargs = dict(host=host, port=port, **kwargs)
+        self._pool_size = pool_size
+        self._clients = []
+        self._idle = None
+        self._closed = False
+
+    def __enter__(self):
+        """enter"""
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        """exit"""
+        self.close()
+
+    async def _acquire(self):
+        """take an idle client, connect a new one if the pool is not full"""
+        if self._closed:
+            raise RuntimeError("Client closed")
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+
+        if self._idle.empty() and len(self._clients) < self._pool_size:
+            c = client.Client(**self._kwargs)
+            self._clients.append(c)
+        else:
+            c = await self._idle.get()
+            if self._closed:
+                # wake up the next caller waiting for a client
+                self._idle.put_nowait(c)
+                raise RuntimeError("Client closed")
+            if c._transport is not None and not c._transport.is_closing():
+                return c
+
+        try:
+            await c.connect()
+        except Exception:
+            self._clients.remove(c)
+            raise
+        return c
+
+    async def _call(self, method, *args, **kwargs):
+        """run a client method with a client of the pool"""
+        c = await self._acquire()
+        try:
+            return await getattr(c, method)(*args, **kwargs)
+        finally:
+            self._release(c)
+
+    def _release(self, c):
+        """give the client back to the pool, it is closed if the pool is"""
+        if self._closed:
+            c.close()
+        self._idle.put_nowait(c)
+
+    async def _close(self):
+        """close all clients, the calls in flight close theirs when they end"""
+        self._closed = True
+        for c in self._clients:
+            c.close()
+        self._clients = []
+        while self._idle is not None and not self._idle.empty():
+            self._idle.get_nowait()
+
+    def bind_request(self, use_classicstun=False, attrs=[], remote_addr=None):
+        """send bind request"""
+        return run(self._call("bind_request", use_classicstun=use_classicstun,
+                              attrs=attrs, remote_addr=remote_addr))
+
+    def get_mapped_address(self, use_classicstun=False, remote_addr=None):
+        """get mapped address"""
+        return run(self._call("get_mapped_address", use_classicstun=use_classicstun,
+                              remote_addr=remote_addr))
+
+    def close(self):
+        """close the pooled clients, the next calls raise RuntimeError"""
+        run(self._close())
+
+
+class SyncNAT:
+    def __init__(self, **kwargs):
+        """blocking nat discovery, the arguments are the ones of aiostun.NAT"""
+        self._nat = nat.NAT(**kwargs)
+
+    def discover(self, use_classicstun=False, **kwargs):
+        """Discovery NAT"""
+        return run(self._nat.discover(use_classicstun=use_classicstun, **kwargs))
+
+    def classic_discover(self, **kwargs):
+        """discover like described in the rfc3489"""
+        return run(self._nat.classic_discover(**kwargs))
+
+    def analyze_port_allocation(self, stun_servers, **kwargs):
+        """classify the port allocation of the nat"""
+        return run(self._nat.analyze_port_allocation(stun_servers, **kwargs))
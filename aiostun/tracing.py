@@ -0,0 +1,80 @@
+import time
+
+# transaction lifecycle events, a tracer is called with (event, transaction_id, timestamp)
+# the timestamp is read from time.monotonic(), first_byte is sent once the header of the
+# response is parsed, with the time its first byte was received
+EVENT_SEND = "send"
+EVENT_RETRANSMIT = "retransmit"
+EVENT_FIRST_BYTE = "first_byte"
+EVENT_DECODED = "decoded"
+EVENT_MATCHED = "matched"
+EVENT_UNMATCHED = "unmatched"
+EVENT_TIMEOUT = "timeout"
+
+class Span:
+    def __init__(self, transaction_id, start):
+        """init"""
+        self.transaction_id = transaction_id
+        self.start = start
+        self.end = None
+        self.status = None
+        self.events = []
+
+    def duration(self):
+        """span duration in seconds"""
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def __str__(self):
+        """string representation"""
+        ret = [ "Transaction %s: %s" % (self.transaction_id, self.status) ]
+        for event, ts in self.events:
+            ret.append( "\t+%.6f %s" % (ts - self.start, event) )
+        return "\n".join(ret)
+
+class SpanTracer:
+    def __init__(self, on_span=None, otel_tracer=None, max_spans=1024):
+        """init"""
+        self.on_span = on_span
+        self.otel_tracer = otel_tracer
+        self.max_spans = max_spans
+        self.spans = {}
+        # offset to convert monotonic timestamps to the epoch based ones of opentelemetry
+        self._epoch_offset = time.time_ns() - time.monotonic_ns()
+
+    def __call__(self, event, transaction_id, timestamp):
+        """receive a lifecycle event"""
+        if event == EVENT_SEND and transaction_id not in self.spans:
+            if len(self.spans) >= self.max_spans:
+                self.spans.pop(next(iter(self.spans)))
+            self.spans[transaction_id] = Span(transaction_id, timestamp)
+
+        span = self.spans.get(transaction_id)
+        if span is None:
+            return
+
+        span.events.append((event, timestamp))
+
+        if event in [EVENT_MATCHED, EVENT_TIMEOUT]:
+            span.end = timestamp
+            span.status = event
+            del self.spans[transaction_id]
+            self.finish(span)
+
+    def finish(self, span):
+        """forward a completed span"""
+        if self.otel_tracer is not None:
+            otel_span = self.otel_tracer.start_span("stun.transaction", start_time=self._to_ns(span.start))
+            otel_span.set_attribute("stun.transaction_id", span.transaction_id.hex())
+            otel_span.set_attribute("stun.status", span.status)
+            for event, ts in span.events:
+                otel_span.add_event(event, timestamp=self._to_ns(ts))
+            otel_span.end(end_time=self._to_ns(span.end))
+
+        if self.on_span is not None:
+            self.on_span(span)
+
+    def _to_ns(self, timestamp):
+        """monotonic seconds to epoch nanoseconds"""
+        return int(timestamp * 1e9) + self._epoch_offset
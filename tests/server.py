@@ -0,0 +1,36 @@
+import struct
+
+import aiostun
+from aiostun import constants
+
+
+class StunResponder:
+    """minimal udp stun server answering binding requests"""
+    def __init__(self, drop=0, mapper=None):
+        self.codec = aiostun.Codec()
+        self.drop = drop
+        self.mapper = mapper
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.drop > 0:
+            self.drop -= 1
+            return
+        self.codec.buf = data
+        req = self.codec.decode()
+
+        # the mapper simulates the port allocation of a nat
+        port = addr[1] if self.mapper is None else self.mapper(addr, self.transport.get_extra_info("sockname"))
+        attr = aiostun.attribute.Attribute(constants.ATTR_MAPPED_ADDRESS)
+        attr.params["value"] = struct.pack("!BBH4s", 0, constants.FAMILY_IP4, port, bytes([127, 0, 0, 1]))
+        resp = aiostun.Message(constants.CLASS_SUCCESS, constants.METHOD_BINDING, [attr])
+        resp.transaction_id = req.transaction_id
+        self.transport.sendto(self.codec.encode(resp), addr)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
@@ -0,0 +1,80 @@
+import struct
+import unittest
+
+import aiostun
+from aiostun import bulk
+from aiostun import constants
+
+
+BINDING_SUCCESS = bytes.fromhex(
+    "010100482112a4427a54477269564651786d7749"
+    "002000080001a8e877ff14ec"
+    "00010008000189fa56edb0ae"
+    "802b000800010050d827fc0f"
+    "80220018436f7475726e2d342e352e32202764616e20456964657227"
+    "80280004d7caaa2b"
+)
+
+def xor_ip6_response(tid, ip, port):
+    """binding success response with a xor-mapped ipv6 address"""
+    key = struct.pack("!L", constants.MAGIC_COOKIE) + tid
+    host = bytes(a ^ b for a, b in zip(ip, key))
+    attr = struct.pack("!HHBBH", constants.ATTR_XOR_MAPPED_ADDRESS, 20, 0, constants.FAMILY_IP6,
+                       port ^ (constants.MAGIC_COOKIE >> 16)) + host
+    return struct.pack("!HHL12s", 0x0101, len(attr), constants.MAGIC_COOKIE, tid) + attr
+
+
+@unittest.skipIf(bulk.np is None, "numpy is not installed")
+class TestBulkDecode(unittest.TestCase):
+    def test_same_as_codec(self):
+        """bulk decoding gives the same result as the codec"""
+        messages = [BINDING_SUCCESS, xor_ip6_response(b"abcdefghijkl", bytes(range(16)), 5000)]
+
+        result = bulk.decode(messages)
+        ips = bulk.ip_strings(result)
+
+        for i, msg in enumerate(messages):
+            codec = aiostun.Codec()
+            codec.buf = msg
+            decoded = codec.decode()
+            addr = decoded.get_attribute(aiostun.attribute.AttrXorMappedAddr)
+            self.assertEqual(result["msgclass"][i], decoded.msgclass)
+            self.assertEqual(result["msgmethod"][i], decoded.msgmethod)
+            self.assertEqual(bytes(result["transaction_id"][i]), decoded.transaction_id)
+            self.assertEqual(result["port"][i], addr.params["port"])
+            self.assertEqual(ips[i], addr.params["ip"])
+
+    def test_concatenated_buffer(self):
+        """split a buffer of concatenated messages, truncated tail ignored"""
+        buf = BINDING_SUCCESS * 3 + BINDING_SUCCESS[:30]
+
+        result = bulk.decode(buf)
+
+        self.assertEqual(len(result), 3)
+        self.assertEqual(list(result["offset"]), [0, 92, 184])
+        self.assertEqual(bulk.ip_strings(result), ["86.237.176.174"] * 3)
+
+    def test_truncated_messages(self):
+        """truncated messages and no address"""
+        no_addr = bytes.fromhex("000100002112a4427a54477269564651786d7749")
+
+        result = bulk.decode([b"short", BINDING_SUCCESS[:40], no_addr])
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result["family"][0], 0)
+        self.assertEqual(bulk.ip_strings(result), [None])
+
+    def test_bad_address_length(self):
+        """an ipv4 address attribute longer than 8 bytes is malformed, as for the codec"""
+        attr = bytes.fromhex("0020000c0001a8e877ff14ec00000000")
+        msg = struct.pack("!HHL12s", 0x0101, len(attr), constants.MAGIC_COOKIE, b"abcdefghijkl") + attr
+
+        codec = aiostun.Codec()
+        codec.buf = msg
+        self.assertIsNone(codec.decode())
+        self.assertEqual(codec.rejected, 1)
+
+        result = bulk.decode([msg])
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result["family"][0], 0)
+        self.assertEqual(bulk.ip_strings(result), [None])
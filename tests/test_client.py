@@ -0,0 +1,109 @@
+import asyncio
+import unittest
+
+import aiostun
+from aiostun import metrics
+from tests.server import StunResponder
+
+
+class TestClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        self.server, self.responder = await loop.create_datagram_endpoint(StunResponder, local_addr=("127.0.0.1", 0))
+        self.port = self.server.get_extra_info("sockname")[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+
+    async def test_stale_response(self):
+        """a late response does not poison the next request"""
+        registry = aiostun.Registry()
+        async with aiostun.Client(host="127.0.0.1", port=self.port, metrics=registry) as stunc:
+            # a response to a previous request is already in the queue
+            stale = aiostun.Message(aiostun.constants.CLASS_SUCCESS, aiostun.METHOD_BINDING, [])
+            stunc._stun_codec._put(stale)
+
+            resp = await stunc.bind_request()
+
+        self.assertIsNotNone(resp)
+        self.assertEqual(registry.get(metrics.RESPONSES_UNMATCHED), 1)
+        self.assertEqual(registry.get(metrics.RESPONSES_MATCHED), 1)
+
+    async def test_bogus_length(self):
+        """a datagram is decoded on its own, a bogus length does not hold the next ones"""
+        registry = aiostun.Registry()
+        async with aiostun.Client(host="127.0.0.1", port=self.port, metrics=registry) as stunc:
+            # success response header announcing more bytes than the datagram has
+            self.server.sendto(bytes.fromhex("01010ff0" + "2112a442") + b"a"*12, stunc.get_local_addr())
+            await asyncio.sleep(0.01)
+
+            mapped_addr = await stunc.get_mapped_address()
+            self.assertEqual(stunc._stun_codec.buf, b"")
+
+        self.assertTrue(mapped_addr)
+        self.assertEqual(stunc._stun_codec.rejected, 1)
+        self.assertEqual(registry.get(metrics.DECODE_ERRORS), 1)
+
+    async def test_messages(self):
+        """stream the messages which are not responses to a request"""
+        async with aiostun.Client(host="127.0.0.1", port=self.port) as stunc:
+            received = []
+
+            async def consume():
+                async for msg in stunc.messages():
+                    received.append(msg)
+
+            task = asyncio.create_task(consume())
+            await asyncio.sleep(0)
+
+            # response to a request, not streamed
+            self.assertIsNotNone(await stunc.bind_request())
+
+            # indication sent by the server
+            indication = aiostun.Message(aiostun.CLASS_INDICATION, aiostun.METHOD_BINDING, [])
+            self.responder.transport.sendto(self.responder.codec.encode(indication), stunc.get_local_addr())
+            while not received:
+                await asyncio.sleep(0.01)
+            stunc.close()
+            await asyncio.wait_for(task, timeout=1)
+
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].msgclass, aiostun.CLASS_INDICATION)
+
+    async def test_messages_one_consumer(self):
+        """a second consumer is refused, the drops of a slow one are counted"""
+        registry = aiostun.Registry()
+        async with aiostun.Client(host="127.0.0.1", port=self.port, metrics=registry, queue_size=2) as stunc:
+            stream = stunc.messages()
+            task = asyncio.ensure_future(stream.__anext__())
+            await asyncio.sleep(0)
+
+            with self.assertRaises(RuntimeError):
+                async for _ in stunc.messages():
+                    pass
+
+            # delivered before the consumer runs again, one is dropped
+            data = b"".join(self.responder.codec.encode(aiostun.Message(aiostun.CLASS_INDICATION, aiostun.METHOD_BINDING, []))
+                            for _ in range(3))
+            stunc._stun_codec.feed_data(data)
+            first = await asyncio.wait_for(task, 1)
+            second = await asyncio.wait_for(stream.__anext__(), 1)
+            await stream.aclose()
+
+        self.assertEqual(first.msgclass, aiostun.CLASS_INDICATION)
+        self.assertEqual(second.msgclass, aiostun.CLASS_INDICATION)
+        self.assertEqual(registry.get(metrics.QUEUE_DROPPED), 1)
+
+    async def test_on_message_batch(self):
+        """messages received in the same loop iteration are delivered at once"""
+        batches = []
+        async with aiostun.Client(host="127.0.0.1", port=self.port) as stunc:
+            stunc.on_message(batches.append, batch=True)
+            data = b"".join(self.responder.codec.encode(aiostun.Message(aiostun.CLASS_INDICATION, aiostun.METHOD_BINDING, []))
+                            for _ in range(3))
+            stunc._stun_codec.feed_data(data)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(len(batches[0]), 3)
+        self.assertIsNone(batches[-1])
@@ -1,5 +1,9 @@
+import sys
+import threading
 import unittest
+import unittest.mock
 import aiostun
+from aiostun import stun
 
 
 
@@ -113,6 +117,13 @@ class TestDecode(unittest.TestCase):
         self.assertIsNone(decoded)
 
 
+class TestTransactionId(unittest.TestCase):
+    def test_uniform(self):
+        """random bytes above the last multiple of 52 are dropped"""
+        with unittest.mock.patch("os.urandom", side_effect=[bytes([255, 208, 0]), bytes([51, 52, 207])]):
+            self.assertEqual(stun.gen_id(length=3), b"aZa")
+
+
 class TestEncode(unittest.TestCase):
     def test_binding_request(self):
         codec = aiostun.Codec()
@@ -125,4 +136,186 @@ class TestEncode(unittest.TestCase):
         codec.buf = msg
         decoded = codec.decode()
        
-        self.assertIsNotNone(decoded)
\ No newline at end of file
+        self.assertIsNotNone(decoded)
+
+class TestValidation(unittest.TestCase):
+    HEADER = "0101%04x" + "2112a442" + "7a54477269564651786d7749"
+
+    def frame(self, attrs="", header=None):
+        return bytes.fromhex((header or self.HEADER) % (len(attrs) // 2) + attrs)
+
+    def test_reject_header(self):
+        """top bits, length and size are checked before parsing"""
+        codec = aiostun.Codec(max_size=64)
+        for data in [ b"\x80" + self.frame()[1:],
+                      bytes.fromhex("01010002" + "2112a442" + "7a54477269564651786d7749" + "0000"),
+                      self.frame("0000" + "0044" + "00" * 68) ]:
+            codec.buf = data
+            self.assertIsNone(codec.decode())
+            self.assertEqual(codec.buf, b"")
+        self.assertEqual(codec.rejected, 3)
+
+    def test_strict(self):
+        """classic stun is rejected in strict mode only"""
+        data = self.frame(header="0101%04x" + "8112a4427a54477269564651786d7749")
+        codec = aiostun.Codec(strict=True)
+        codec.buf = data
+        self.assertIsNone(codec.decode())
+        self.assertEqual(codec.rejected, 1)
+
+        codec = aiostun.Codec()
+        codec.buf = data
+        self.assertEqual(codec.decode().magic_cookie, 0)
+
+    def test_reject_attributes(self):
+        """too many, truncated or malformed attributes reject the frame"""
+        codec = aiostun.Codec(max_attributes=2)
+        for attrs in [ "80220000" * 3,
+                       "80220008" + "00" * 4,
+                       "000100080003000000000000" ]:
+            codec.buf = self.frame(attrs)
+            self.assertIsNone(codec.decode())
+        self.assertEqual(codec.rejected, 3)
+
+    def test_skip_bad_frame(self):
+        """the next frame is decoded after a rejected one"""
+        codec = aiostun.Codec()
+        codec.buf = self.frame("000100080003000000000000") + self.frame("000100080001000a7f000001")
+        decoded = codec.decode()
+        self.assertEqual(decoded.attributes[0].params["ip"], "127.0.0.1")
+        self.assertEqual((codec.rejected, codec.buf), (1, b""))
+
+
+class TestAddrCache(unittest.TestCase):
+    def setUp(self):
+        self.saved = aiostun.attribute.addr_cache
+        aiostun.attribute.addr_cache = aiostun.attribute.AddrCache(maxsize=2)
+
+    def tearDown(self):
+        aiostun.attribute.addr_cache = self.saved
+
+    def decode(self, attrs, tid="7a54477269564651786d7749"):
+        codec = aiostun.Codec()
+        codec.buf = bytes.fromhex("0101%04x" % (len(attrs) // 2) + "2112a442" + tid + attrs)
+        return codec.decode().attributes
+
+    def test_shared(self):
+        """the same bytes give the same address object"""
+        attrs = "0001000800010bb8c0000201" + "0020000800012aaae112a643"
+        (mapped, xor_mapped) = self.decode(attrs)
+        self.assertEqual((xor_mapped.params["ip"], xor_mapped.params["port"]), ("192.0.2.1", 3000))
+        (mapped_again, xor_again) = self.decode(attrs, tid="6b54477269564651786d7749")
+        self.assertIs(mapped_again.address, mapped.address)
+        self.assertIs(xor_again.address, xor_mapped.address)
+
+        stats = aiostun.attribute.addr_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (2, 2, 2))
+        self.assertEqual(stats["hit-rate"], 0.5)
+
+    def test_lru(self):
+        """bounded, the least recently used address is evicted"""
+        cache = aiostun.attribute.addr_cache
+        for port in ["0001", "0002", "0001", "0003"]:
+            self.decode("000100080001%sc0000201" % port)
+        self.assertEqual(list(cache._entries), [bytes.fromhex("0001%sc0000201" % p) for p in ["0001", "0003"]])
+
+    def test_threads(self):
+        """lookups and evictions from several threads at once"""
+        cache = aiostun.attribute.addr_cache
+        errors = []
+
+        def hammer(seed):
+            try:
+                for i in range(5000):
+                    key = bytes([(seed + i) % 7])
+                    if cache.lookup(key) is None:
+                        cache.store(key, aiostun.attribute.Address(aiostun.IP4, "192.0.2.1", i))
+            except Exception as e:
+                errors.append(e)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [ threading.Thread(target=hammer, args=(n,)) for n in range(8) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(errors, [])
+        stats = cache.stats()
+        self.assertLessEqual(stats["size"], 2)
+        self.assertEqual(stats["hits"] + stats["misses"], 8 * 5000)
+
+    def test_xor_ipv6(self):
+        """the transaction id is part of the ipv6 key, not cached"""
+        self.decode("00200014" + "0002" + "2aaa" + "00" * 16)
+        self.assertEqual(aiostun.attribute.addr_cache.stats()["size"], 0)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.paused = False
+    def pause_reading(self):
+        self.paused = True
+    def resume_reading(self):
+        self.paused = False
+
+
+class TestQueue(unittest.IsolatedAsyncioTestCase):
+    def response(self, tid):
+        codec = aiostun.Codec()
+        req = aiostun.Message(msgclass=aiostun.CLASS_REQUEST, msgmethod=aiostun.METHOD_BINDING, attrs=[])
+        req.transaction_id = tid
+        return codec.encode(req)
+
+    async def test_drop_oldest(self):
+        """oldest messages are dropped when the queue is full"""
+        codec = aiostun.Codec(maxsize=2)
+        for tid in [b"a"*12, b"b"*12, b"c"*12]:
+            codec.feed_data(self.response(tid))
+
+        self.assertEqual((await codec.get()).transaction_id, b"b"*12)
+        self.assertEqual((await codec.get()).transaction_id, b"c"*12)
+
+    async def test_drop_newest(self):
+        """new messages are dropped when the queue is full"""
+        codec = aiostun.Codec(maxsize=2, overflow=aiostun.QUEUE_DROP_NEWEST)
+        for tid in [b"a"*12, b"b"*12, b"c"*12]:
+            codec.feed_data(self.response(tid))
+
+        self.assertEqual((await codec.get()).transaction_id, b"a"*12)
+        self.assertEqual((await codec.get()).transaction_id, b"b"*12)
+        self.assertTrue(codec._queue.empty())
+
+    async def test_pause_reading(self):
+        """the transport is paused while the queue is full"""
+        codec = aiostun.Codec(maxsize=2, overflow=aiostun.QUEUE_PAUSE_READING)
+        codec.transport = FakeTransport()
+        codec.feed_data(b"".join(self.response(tid) for tid in [b"a"*12, b"b"*12, b"c"*12, b"d"*12]))
+        self.assertTrue(codec.transport.paused)
+        self.assertEqual(codec._queue.qsize(), 2)
+
+        tids = [ (await codec.get()).transaction_id for _ in range(4) ]
+        self.assertEqual(tids, [b"a"*12, b"b"*12, b"c"*12, b"d"*12])
+        self.assertFalse(codec.transport.paused)
+
+    async def test_drop_stale(self):
+        """responses to requests no longer pending are not queued"""
+        registry = aiostun.Registry()
+        codec = aiostun.Codec(metrics=registry)
+        codec.add_pending(b"a"*12)
+        for msgclass, tid in [(aiostun.constants.CLASS_SUCCESS, b"b"*12),
+                              (aiostun.constants.CLASS_ERROR, b"c"*12),
+                              (aiostun.constants.CLASS_SUCCESS, b"a"*12),
+                              (aiostun.CLASS_REQUEST, b"d"*12)]:
+            msg = aiostun.Message(msgclass, aiostun.METHOD_BINDING, [])
+            msg.transaction_id = tid
+            codec._put(msg)
+
+        self.assertEqual((await codec.get()).transaction_id, b"a"*12)
+        self.assertEqual((await codec.get()).transaction_id, b"d"*12)
+        self.assertTrue(codec._queue.empty())
+        self.assertEqual(registry.get(aiostun.metrics.RESPONSES_UNMATCHED), 2)
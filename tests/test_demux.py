@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+
+import aiostun
+from aiostun import demux
+from tests.server import StunResponder
+
+
+class AppProtocol:
+    def __init__(self):
+        self.transport = None
+        self.received = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received.append(data)
+
+
+class TestDemux(unittest.TestCase):
+    def test_classify(self):
+        """classify by first byte"""
+        self.assertEqual(demux.classify(b"\x00\x01"), demux.PACKET_STUN)
+        self.assertEqual(demux.classify(b"\x16\xfe\xfd"), demux.PACKET_DTLS)
+        self.assertEqual(demux.classify(b"\x80\x60"), demux.PACKET_RTP)
+        self.assertEqual(demux.classify(b"\x40"), demux.PACKET_TURN_CHANNEL)
+        self.assertIsNone(demux.classify(b"\xff"))
+        self.assertIsNone(demux.classify(b""))
+
+
+class TestDemuxClient(unittest.IsolatedAsyncioTestCase):
+    async def test_shared_socket(self):
+        """stun, dtls and rtp on the same socket"""
+        loop = asyncio.get_running_loop()
+        server, responder = await loop.create_datagram_endpoint(StunResponder, local_addr=("127.0.0.1", 0))
+        port = server.get_extra_info("sockname")[1]
+
+        dtls = AppProtocol()
+        rtp = AppProtocol()
+        registry = aiostun.Registry()
+        async with aiostun.Client(host="127.0.0.1", port=port, demux=True, metrics=registry) as stunc:
+            stunc.register_protocol(demux.PACKET_DTLS, dtls)
+            stunc.register_protocol(demux.PACKET_RTP, rtp)
+
+            local_addr = stunc.get_local_addr()
+            dtls_record = b"\x16\xfe\xfd" + b"\x00" * 10
+            rtp_packet = b"\x80\x60" + b"\x00" * 10
+            for data in [dtls_record, rtp_packet, b"\x40\x00\x00\x00"]:
+                server.sendto(data, local_addr)
+
+            mapped_addr = await stunc.get_mapped_address()
+            await asyncio.sleep(0.01)
+
+            # the application sends on the same socket
+            self.assertIs(dtls.transport, stunc._transport)
+        server.close()
+
+        self.assertEqual(mapped_addr["port"], local_addr[1])
+        self.assertEqual(dtls.received, [dtls_record])
+        self.assertEqual(rtp.received, [rtp_packet])
+        self.assertEqual(registry.get(aiostun.metrics.DEMUX_DROPPED), 1)
+
+    def test_requires_demux(self):
+        """registration without demux"""
+        with self.assertRaises(RuntimeError):
+            aiostun.Client(host="127.0.0.1").register_protocol(demux.PACKET_DTLS, AppProtocol())
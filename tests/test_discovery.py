@@ -0,0 +1,76 @@
+import socket
+import unittest
+
+import aiostun
+from aiostun import constants
+from aiostun import discovery
+from aiostun import nat
+
+
+class TestLocalAddresses(unittest.TestCase):
+    def test_filters(self):
+        """loopback and link-local addresses are skipped by default"""
+        for ifname, family, ip in discovery.local_addresses():
+            self.assertIn(family, [constants.FAMILY_IP4, constants.FAMILY_IP6])
+            self.assertFalse(ip.startswith("127.") or ip == "::1")
+            self.assertFalse(ip.startswith("169.254.") or ip.lower().startswith("fe80:"))
+
+
+class TestDiscoverAll(unittest.IsolatedAsyncioTestCase):
+    async def test_dual_stack(self):
+        """one report per address, an error for the family without server"""
+        async with aiostun.Server(host="127.0.0.1", port=0) as server:
+            (host, port) = server.get_local_addr()
+            addresses = [ ("lo", constants.FAMILY_IP4, "127.0.0.1"), ("lo", constants.FAMILY_IP6, "::1") ]
+            report = await discovery.discover_all(stun_host=host, stun_port=port, addresses=addresses,
+                                                  timeout=1)
+
+        (ip4, ip6) = report["interfaces"]
+        self.assertEqual(ip4["local-ip"], "127.0.0.1")
+        self.assertEqual(ip4["mapped-address"]["ip"], "127.0.0.1")
+        self.assertEqual(ip4["nat"]["local-ip"], "127.0.0.1")
+        self.assertEqual(ip4["nat"]["external-ip"], "127.0.0.1")
+        self.assertIn("error", ip6)
+
+    async def test_error_response(self):
+        """a server answering with errors gives a report per address, not an exception"""
+        limiter = aiostun.RateLimiter(rate=0, burst=0, slip=1)
+        async with aiostun.Server(host="127.0.0.1", port=0, rate_limiter=limiter) as server:
+            (host, port) = server.get_local_addr()
+            addresses = [ ("lo", constants.FAMILY_IP4, "127.0.0.1") ] * 2
+            report = await discovery.discover_all(stun_host=host, stun_port=port, addresses=addresses,
+                                                  timeout=1)
+
+        for entry in report["interfaces"]:
+            self.assertEqual(entry["mapped-address"], {})
+            self.assertEqual(entry["nat"]["error"], nat.PROTOCOL_ERROR)
+
+    @unittest.skipIf(not socket.has_ipv6, "no ipv6")
+    async def test_ipv6(self):
+        """mapped address over ipv6"""
+        try:
+            server = await aiostun.Server(host="::1", port=0, family=constants.FAMILY_IP6).start()
+        except OSError:
+            self.skipTest("no ipv6 loopback")
+        (host, port) = server.get_local_addr()[:2]
+        addresses = [ ("lo", constants.FAMILY_IP6, "::1") ]
+        report = await discovery.discover_all(stun_host=host, stun_port=port, addresses=addresses,
+                                              use_nat=False, timeout=1)
+        server.close()
+
+        (ip6,) = report["interfaces"]
+        self.assertEqual(ip6["mapped-address"]["ip"], "::1")
+        self.assertNotIn("nat", ip6)
+
+    async def test_concurrent(self):
+        """the probes run at once, the total is bounded by the slowest one"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+            addresses = [ ("lo", constants.FAMILY_IP4, "127.0.0.1") ] * 3
+            report = await discovery.discover_all(stun_host="127.0.0.1", stun_port=port,
+                                                  addresses=addresses, use_nat=False, timeout=0.5)
+
+        durations = [ r["duration"] for r in report["interfaces"] ]
+        self.assertEqual([ r["mapped-address"] for r in report["interfaces"] ], [{}] * 3)
+        self.assertLess(report["duration"], sum(durations) * 0.6)
@@ -0,0 +1,113 @@
+import os
+import socket
+import tempfile
+import unittest
+
+import aiostun
+from aiostun import health
+from aiostun import simulator
+
+
+class TestServerRegistry(unittest.TestCase):
+    def registry(self, **kwargs):
+        servers = [ ("a", 3478, aiostun.UDP, aiostun.IP4), ("b", 3478, aiostun.UDP, aiostun.IP4),
+                    ("c", 3478, aiostun.TCP, aiostun.IP4) ]
+        return aiostun.ServerRegistry(servers, **kwargs)
+
+    def test_score(self):
+        """fast servers first, lossy ones after unknown ones"""
+        registry = self.registry(alpha=0.5)
+        self.assertEqual([ s.host for s in registry.best(aiostun.UDP) ], ["a", "b"])
+
+        registry.record_success("b", 3478, aiostun.UDP, aiostun.IP4, rtt=0.1)
+        registry.record_success("b", 3478, aiostun.UDP, aiostun.IP4, rtt=0.3)
+        self.assertAlmostEqual(registry.servers[("b", 3478, aiostun.UDP, aiostun.IP4)].rtt, 0.2)
+        self.assertEqual(registry.pick(aiostun.UDP).host, "b")
+
+        registry.record_failure("b", 3478, aiostun.UDP, aiostun.IP4)
+        self.assertEqual(registry.pick(aiostun.UDP).host, "a")
+        self.assertEqual(registry.pick(aiostun.TCP).host, "c")
+
+        # servers which are not configured are not tracked
+        registry.record_success("d", 3478, aiostun.UDP, aiostun.IP4, rtt=0.1)
+        self.assertEqual(len(registry.servers), 3)
+
+    def test_circuit_breaker(self):
+        """skipped while open, one try once the reset timeout is over"""
+        registry = self.registry(failure_threshold=2, reset_timeout=10)
+        for _ in range(2):
+            registry.record_failure("a", 3478, aiostun.UDP, aiostun.IP4, now=100.0)
+        self.assertEqual([ s.host for s in registry.best(aiostun.UDP, now=105.0) ], ["b"])
+
+        registry.record_failure("b", 3478, aiostun.UDP, aiostun.IP4, now=100.0)
+        registry.record_failure("b", 3478, aiostun.UDP, aiostun.IP4, now=100.0)
+        self.assertIsNone(registry.pick(aiostun.UDP, now=105.0))
+
+        server = registry.pick(aiostun.UDP, now=110.0)
+        self.assertEqual(server.state, health.STATE_HALF_OPEN)
+        # one trial per server, until its outcome or another reset timeout
+        self.assertEqual(registry.pick(aiostun.UDP, now=110.0).host, "b")
+        self.assertIsNone(registry.pick(aiostun.UDP, now=111.0))
+        self.assertEqual(registry.pick(aiostun.UDP, now=120.0).host, "a")
+        registry.record_failure(*server.key(), now=120.0)
+        self.assertEqual(server.state, health.STATE_OPEN)
+        self.assertEqual(server.opened_at, 120.0)
+
+        registry.record_success("b", 3478, aiostun.UDP, aiostun.IP4, rtt=0.1)
+        self.assertEqual(registry.pick(aiostun.UDP, now=121.0).host, "b")
+
+    def test_persist(self):
+        """the state is saved and restored for the configured servers"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "servers.json")
+            registry = self.registry(path=path)
+            registry.record_success("b", 3478, aiostun.UDP, aiostun.IP4, rtt=0.05)
+            registry.save()
+
+            restored = self.registry(path=path)
+            self.assertEqual(restored.pick(aiostun.UDP).host, "b")
+            self.assertEqual(restored.servers[("b", 3478, aiostun.UDP, aiostun.IP4)].rtt, 0.05)
+
+            other = aiostun.ServerRegistry([ ("a", 3478, aiostun.UDP, aiostun.IP4) ], path=path)
+            self.assertEqual(list(other.servers), [ ("a", 3478, aiostun.UDP, aiostun.IP4) ])
+
+            with open(path, "w") as f:
+                f.write("{")
+            self.assertFalse(self.registry(path=path).load())
+
+
+    def test_nat_discovery(self):
+        """the change request probes filtered by the nat are not counted as losses"""
+        async def discover(registry):
+            network = simulator.Network(latency=0.02)
+            server = await simulator.ClassicServer(network, "198.51.100.1", "198.51.100.2").start()
+            host = network.host("10.0.0.2", network.add_nat("203.0.113.1", simulator.NAT_PORT_RESTRICTED))
+            nat_discovery = aiostun.NAT(health=registry, network=host)
+            for _ in range(5):
+                result = await nat_discovery.classic_discover()
+            server.close()
+            return result
+
+        registry = aiostun.ServerRegistry([ ("198.51.100.1", 3478, aiostun.UDP, aiostun.IP4) ])
+        result = simulator.run(discover(registry))
+        (server,) = registry.servers.values()
+        self.assertEqual(result["external-ip"], "203.0.113.1")
+        self.assertEqual((server.loss, server.failures, server.state), (0.0, 0, health.STATE_CLOSED))
+        self.assertAlmostEqual(server.rtt, 0.04)
+
+class TestClientHealth(unittest.IsolatedAsyncioTestCase):
+    async def test_get_mapped_address(self):
+        """a dead server is recorded and the next one is used"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as dead:
+            dead.bind(("127.0.0.1", 0))
+            async with aiostun.Server(host="127.0.0.1", port=0) as server:
+                servers = [ ("127.0.0.1", dead.getsockname()[1], aiostun.UDP, aiostun.IP4),
+                            ("127.0.0.1", server.get_local_addr()[1], aiostun.UDP, aiostun.IP4) ]
+                registry = aiostun.ServerRegistry(servers, timeout=0.2)
+                mapped_addr = await registry.get_mapped_address()
+
+        self.assertEqual(mapped_addr["ip"], "127.0.0.1")
+        (dead_health, alive_health) = registry.servers.values()
+        self.assertEqual(dead_health.failures, 1)
+        self.assertIsNotNone(alive_health.rtt)
+        self.assertEqual(registry.pick().port, servers[1][1])
@@ -0,0 +1,66 @@
+import os
+import sys
+import subprocess
+import unittest
+
+import aiostun
+
+# budget for the modules of the package itself, in microseconds, only
+# checked with AIOSTUN_IMPORT_BUDGET=1 because wall clock time is noisy
+IMPORT_BUDGET_US = 30000
+
+
+def loaded_modules(code):
+    """run the code in a fresh interpreter and return the names in sys.modules"""
+    proc = subprocess.run([sys.executable, "-c", code + "; import sys; print(' '.join(sys.modules))"],
+                          capture_output=True, text=True, check=True)
+    return set(proc.stdout.split())
+
+
+def import_time(code):
+    """run the code in a fresh interpreter and return the loaded modules and import times"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        if self_us.strip().isdigit():
+            times[name.strip()] = int(self_us)
+    return times
+
+
+class TestImport(unittest.TestCase):
+    def test_lazy_import(self):
+        """heavy modules and the submodules are not loaded by import aiostun"""
+        modules = loaded_modules("import aiostun")
+        for name in ["ssl", "ipaddress", "numpy"]:
+            self.assertNotIn(name, modules)
+        for name in aiostun._LAZY_MODULES:
+            self.assertNotIn("aiostun.%s" % name, modules)
+
+    def test_client_import(self):
+        """ipaddress is not loaded by the client until an address is formatted, ssl comes with asyncio"""
+        modules = loaded_modules("import aiostun.client, aiostun.nat")
+        self.assertIn("aiostun.client", modules)
+        for name in ["ipaddress", "numpy"]:
+            self.assertNotIn(name, modules)
+
+    @unittest.skipUnless(os.environ.get("AIOSTUN_IMPORT_BUDGET"), "set AIOSTUN_IMPORT_BUDGET=1 to check the import time")
+    def test_import_budget(self):
+        """import time of the package modules, the best of three runs to ignore the noise"""
+        spent = []
+        for _ in range(3):
+            times = import_time("import aiostun.client, aiostun.nat")
+            spent.append(sum(t for name, t in times.items() if name.startswith("aiostun")))
+        self.assertLess(min(spent), IMPORT_BUDGET_US)
+
+    def test_lazy_attributes(self):
+        """lazy attributes resolve to the classes"""
+        import aiostun
+        from aiostun import stun
+        self.assertIs(aiostun.Codec, stun.Codec)
+        self.assertIn("Client", dir(aiostun))
+        with self.assertRaises(AttributeError):
+            aiostun.Unknown
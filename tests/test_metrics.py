@@ -0,0 +1,56 @@
+import asyncio
+import unittest
+
+import aiostun
+from aiostun import metrics
+from tests.server import StunResponder
+
+
+class TestRegistry(unittest.TestCase):
+    def test_counters_and_histograms(self):
+        """record metrics and render them"""
+        registry = aiostun.Registry()
+        registry.inc(metrics.REQUESTS_SENT, labels={"server": "a:1"})
+        registry.inc(metrics.REQUESTS_SENT, labels={"server": "a:1"})
+        registry.set(metrics.QUEUE_DEPTH, 3)
+        registry.observe(metrics.RTT_SECONDS, 0.02, labels={"server": "a:1"})
+
+        self.assertEqual(registry.get(metrics.REQUESTS_SENT, labels={"server": "a:1"}), 2)
+        self.assertEqual(registry.get(metrics.QUEUE_DEPTH), 3)
+        self.assertEqual(registry.get(metrics.RTT_SECONDS, labels={"server": "a:1"})["count"], 1)
+
+        text = registry.to_prometheus()
+        self.assertIn('aiostun_requests_sent_total{server="a:1"} 2', text)
+        self.assertIn("aiostun_queue_depth 3", text)
+        self.assertIn('aiostun_rtt_seconds_bucket{server="a:1",le="0.025"} 1', text)
+        self.assertIn('aiostun_rtt_seconds_bucket{server="a:1",le="0.01"} 0', text)
+        self.assertIn('aiostun_rtt_seconds_count{server="a:1"} 1', text)
+
+    def test_decode_errors(self):
+        """count decode errors, the bad frame is dropped without exception"""
+        registry = aiostun.Registry()
+        codec = aiostun.Codec(metrics=registry)
+        codec.feed_data(bytes.fromhex("0101000c" + "2112a442" + "7a54477269564651786d7749" + "000100080009000000000000"))
+        self.assertEqual(registry.get(metrics.DECODE_ERRORS), 1)
+        self.assertEqual(codec.buf, b"")
+
+
+class TestClientMetrics(unittest.IsolatedAsyncioTestCase):
+    async def test_bind_request(self):
+        """metrics recorded by the client on a local server"""
+        loop = asyncio.get_running_loop()
+        server, _ = await loop.create_datagram_endpoint(lambda: StunResponder(drop=1), local_addr=("127.0.0.1", 0))
+        port = server.get_extra_info("sockname")[1]
+
+        registry = aiostun.Registry()
+        async with aiostun.Client(host="127.0.0.1", port=port, retransmissions=2, rto=0.05, metrics=registry) as stunc:
+            mapped_addr = await stunc.get_mapped_address()
+        server.close()
+
+        label = {"server": "127.0.0.1:%s" % port}
+        self.assertEqual(mapped_addr["ip"], "127.0.0.1")
+        self.assertEqual(registry.get(metrics.REQUESTS_SENT, labels=label), 2)
+        self.assertEqual(registry.get(metrics.RETRANSMITS), 1)
+        self.assertEqual(registry.get(metrics.RESPONSES_MATCHED), 1)
+        self.assertEqual(registry.get(metrics.RTT_SECONDS, labels=label)["count"], 1)
+        self.assertGreater(registry.get(metrics.BYTES_IN), 0)
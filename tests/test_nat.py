@@ -0,0 +1,119 @@
+import random
+import asyncio
+import unittest
+
+import aiostun
+from aiostun import nat
+from aiostun import simulator
+from tests.server import StunResponder
+
+
+class SequentialNAT:
+    """symmetric nat allocating the external ports with a fixed delta"""
+    def __init__(self, start=40000, delta=2):
+        self.next_port = start
+        self.delta = delta
+        self.mappings = {}
+
+    def __call__(self, client_addr, server_addr):
+        key = (client_addr, server_addr)
+        if key not in self.mappings:
+            self.mappings[key] = self.next_port
+            self.next_port += self.delta
+        return self.mappings[key]
+
+
+class TestClassify(unittest.TestCase):
+    def samples(self, ports, servers=1):
+        return [ {"local-port": 1000 + i // servers, "server": i % servers, "mapped-port": p}
+                 for i, p in enumerate(ports) ]
+
+    def test_port_preserving(self):
+        """mapped port equals the local port"""
+        samples = [ {"local-port": p, "server": 0, "mapped-port": p} for p in range(1000, 1100) ]
+        result = nat.classify_port_allocation(samples)
+        self.assertEqual(result["allocation"], nat.ALLOC_PORT_PRESERVING)
+        self.assertEqual(result["mapping"], nat.MAPPING_ENDPOINT_INDEPENDENT)
+
+    def test_sequential(self):
+        """constant delta with a few gaps, across the port wrap around"""
+        ports = [ (65500 + 3 * i) % 65536 for i in range(50) ]
+        ports[20:] = [ (p + 3) % 65536 for p in ports[20:] ]
+        result = nat.classify_port_allocation(self.samples(ports))
+        self.assertEqual(result["allocation"], nat.ALLOC_SEQUENTIAL)
+        self.assertEqual(result["delta"], 3)
+        # the gap widens the predicted range
+        self.assertEqual(result["predicted-ports"], ((ports[-1] + 3) % 65536, (ports[-1] + 6) % 65536))
+
+    def test_sequential_decreasing(self):
+        """negative delta, the gaps widen the range below the next port"""
+        ports = [ (100 - 2 * i) % 65536 for i in range(50) ]
+        ports[20:] = [ (p - 2) % 65536 for p in ports[20:] ]
+        result = nat.classify_port_allocation(self.samples(ports))
+        self.assertEqual(result["allocation"], nat.ALLOC_SEQUENTIAL)
+        self.assertEqual(result["delta"], -2)
+        self.assertEqual(result["predicted-ports"], ((ports[-1] - 4) % 65536, (ports[-1] - 2) % 65536))
+
+    def test_random(self):
+        """no dominant delta"""
+        rand = random.Random(42)
+        ports = [ rand.randint(1024, 65535) for _ in range(100) ]
+        result = nat.classify_port_allocation(self.samples(ports))
+        self.assertEqual(result["allocation"], nat.ALLOC_RANDOM)
+        self.assertEqual(result["predicted-ports"], (min(ports), max(ports)))
+
+
+class TestAnalyzer(unittest.IsolatedAsyncioTestCase):
+    async def test_symmetric_sequential(self):
+        """survey a simulated symmetric nat through two servers"""
+        loop = asyncio.get_running_loop()
+        mapper = SequentialNAT()
+        servers = []
+        transports = []
+        for _ in range(2):
+            transport, _ = await loop.create_datagram_endpoint(lambda: StunResponder(mapper=mapper),
+                                                               local_addr=("127.0.0.1", 0))
+            transports.append(transport)
+            servers.append(transport.get_extra_info("sockname"))
+
+        try:
+            # the simulated nat allocates on reception, probe one socket at a time
+            # so that it matches the sending order
+            result = await aiostun.NAT().analyze_port_allocation(servers, sockets=50, concurrency=1, timeout=1)
+        finally:
+            for transport in transports:
+                transport.close()
+
+        self.assertEqual(len(result["details"]), 100)
+        self.assertEqual(len(set(s["local-port"] for s in result["details"])), 50)
+        self.assertEqual(result["allocation"], nat.ALLOC_SEQUENTIAL)
+        self.assertEqual(result["delta"], 2)
+        self.assertEqual(result["mapping"], nat.MAPPING_ENDPOINT_DEPENDENT)
+        self.assertEqual(result["predicted-ports"][0], mapper.next_port)
+
+
+class TestSimulatedAnalyzer(unittest.TestCase):
+    async def analyze(self):
+        network = simulator.Network(latency=0.02, jitter=0.01, seed=3)
+        servers = []
+        for ip in ["198.51.100.1", "198.51.100.2"]:
+            servers.append(await aiostun.Server(host=ip, network=network.host(ip)).start())
+        box = network.add_nat("203.0.113.1", simulator.NAT_SYMMETRIC, first_port=40000)
+        host = network.host("10.0.0.2", box)
+        try:
+            result = await nat.NAT(network=host).analyze_port_allocation(
+                [("198.51.100.1", 3478), ("198.51.100.2", 3478)], sockets=50, concurrency=16, timeout=1)
+        finally:
+            for server in servers:
+                server.close()
+        return result, box
+
+    def test_concurrent_probes(self):
+        """the simulated nat allocates on send, the probes can run concurrently"""
+        (result, box) = simulator.run(self.analyze())
+        self.assertEqual(len(result["details"]), 100)
+        self.assertEqual(len(set(s["local-port"] for s in result["details"])), 50)
+        self.assertEqual(result["allocation"], nat.ALLOC_SEQUENTIAL)
+        self.assertEqual(result["delta"], 1)
+        self.assertEqual(result["mapping"], nat.MAPPING_ENDPOINT_DEPENDENT)
+        self.assertEqual(result["predicted-ports"][0], box._next_port)
@@ -0,0 +1,148 @@
+import os
+import struct
+import tempfile
+import unittest
+import unittest.mock
+
+import aiostun
+from aiostun import pcap
+
+
+BINDING_SUCCESS = bytes.fromhex(
+    "010100482112a4427a54477269564651786d7749"
+    "002000080001a8e877ff14ec"
+    "00010008000189fa56edb0ae"
+    "802b000800010050d827fc0f"
+    "80220018436f7475726e2d342e352e32202764616e20456964657227"
+    "80280004d7caaa2b"
+)
+
+def ethernet_frame(proto, payload, seq=0, flags=0x18):
+    """ethernet + ipv4 + udp/tcp frame from 10.0.0.1:3478 to 10.0.0.2:5000"""
+    if proto == pcap.PROTO_UDP:
+        l4 = struct.pack("!HHHH", 3478, 5000, 8 + len(payload), 0) + payload
+    else:
+        l4 = struct.pack("!HHLLBBHHH", 3478, 5000, seq, 0, 5 << 4, flags, 65535, 0, 0) + payload
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(l4), 0, 0x4000, 64, proto, 0,
+                     bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2]))
+    return b"\x00" * 12 + struct.pack("!H", pcap.ETHERTYPE_IP4) + ip + l4
+
+def write_pcap(path, frames):
+    """classic pcap file"""
+    with open(path, "wb") as f:
+        f.write(struct.pack("<LHHlLLL", pcap.PCAP_MAGIC_USEC, 2, 4, 0, 0, 65535, pcap.LINKTYPE_ETHERNET))
+        for i, frame in enumerate(frames):
+            f.write(struct.pack("<LLLL", i, 0, len(frame), len(frame)) + frame)
+
+def write_pcapng(path, frames):
+    """pcapng file with one interface"""
+    def block(block_type, body):
+        body += b"\x00" * (-len(body) % 4)
+        length = len(body) + 12
+        return struct.pack("<LL", block_type, length) + body + struct.pack("<L", length)
+    with open(path, "wb") as f:
+        f.write(block(pcap.PCAPNG_SHB, struct.pack("<LHHq", pcap.PCAPNG_BYTE_ORDER, 1, 0, -1)))
+        f.write(block(pcap.PCAPNG_IDB, struct.pack("<HHL", pcap.LINKTYPE_ETHERNET, 0, 65535)))
+        for i, frame in enumerate(frames):
+            f.write(block(pcap.PCAPNG_EPB, struct.pack("<LLLLL", 0, 0, i * 1000000, len(frame), len(frame)) + frame))
+
+
+class TestPcap(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # udp message, garbage datagram, tcp stream with two messages split and reordered
+        stream = BINDING_SUCCESS * 2
+        self.frames = [
+            ethernet_frame(pcap.PROTO_UDP, BINDING_SUCCESS),
+            ethernet_frame(pcap.PROTO_UDP, b"\x80" * 40),
+            ethernet_frame(pcap.PROTO_TCP, b"", seq=99, flags=0x02),
+            ethernet_frame(pcap.PROTO_TCP, stream[50:], seq=150),
+            ethernet_frame(pcap.PROTO_TCP, stream[:50], seq=100),
+            ethernet_frame(pcap.PROTO_TCP, stream[:50], seq=100),
+        ]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_messages(self, path):
+        msgs = list(pcap.messages(path))
+        self.assertEqual(len(msgs), 3)
+        for pkt, msg in msgs:
+            self.assertIsInstance(msg, aiostun.Message)
+            self.assertEqual(msg.transaction_id, b"zTGriVFQxmwI")
+            self.assertEqual(pkt.src_addr(), ("10.0.0.1", 3478))
+        self.assertEqual(msgs[0][0].proto, pcap.PROTO_UDP)
+        self.assertEqual(msgs[0][0].timestamp, 0)
+        self.assertEqual(msgs[2][0].timestamp, 4)
+
+    def test_pcap(self):
+        """read udp and tcp stun messages from a pcap file"""
+        path = os.path.join(self.tmpdir.name, "stun.pcap")
+        write_pcap(path, self.frames)
+        self.check_messages(path)
+
+    def test_pcapng(self):
+        """read udp and tcp stun messages from a pcapng file"""
+        path = os.path.join(self.tmpdir.name, "stun.pcapng")
+        write_pcapng(path, self.frames)
+        self.check_messages(path)
+
+    def test_raw(self):
+        """raw payloads of udp stun messages"""
+        path = os.path.join(self.tmpdir.name, "stun.pcap")
+        write_pcap(path, self.frames)
+        msgs = [ bytes(payload) for _, payload in pcap.messages(path, raw=True) ]
+        self.assertEqual(msgs, [BINDING_SUCCESS])
+
+    def test_parallel(self):
+        """shard the capture across processes"""
+        path = os.path.join(self.tmpdir.name, "stun.pcapng")
+        write_pcapng(path, [ethernet_frame(pcap.PROTO_UDP, BINDING_SUCCESS)] * 20)
+        msgs = list(pcap.messages_parallel(path, processes=2, chunk_size=512))
+        self.assertEqual(len(msgs), 20)
+        self.assertEqual([pkt.timestamp for pkt, _ in msgs], list(range(20)))
+
+    def test_parallel_prefetch(self):
+        """no more than prefetch chunks per process are decoded ahead of the consumer"""
+        class Result:
+            def __init__(self, pool, value):
+                self.pool = pool
+                self.value = value
+            def get(self):
+                self.pool.running -= 1
+                return self.value
+
+        class Pool:
+            def __init__(self, processes):
+                self.running = 0
+                self.max_running = 0
+                pools.append(self)
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                pass
+            def apply_async(self, func, args):
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                return Result(self, func(*args))
+
+        pools = []
+        path = os.path.join(self.tmpdir.name, "stun.pcapng")
+        write_pcapng(path, [ethernet_frame(pcap.PROTO_UDP, BINDING_SUCCESS)] * 20)
+        with unittest.mock.patch("multiprocessing.Pool", Pool):
+            msgs = pcap.messages_parallel(path, processes=2, chunk_size=128, prefetch=1)
+            self.assertEqual([pkt.timestamp for pkt, _ in msgs], list(range(20)))
+        self.assertEqual(pools[0].max_running, 2)
+
+    def test_tcp_not_stun(self):
+        """tcp streams which do not start with stun are not buffered"""
+        stream = pcap.TcpStream()
+        self.assertEqual(stream.feed(99, pcap.TCP_SYN, b""), [])
+        self.assertEqual(stream.feed(100, 0, b"GET / HTTP/1.1\r\n\r\n"), [])
+        self.assertEqual(stream.feed(118, 0, BINDING_SUCCESS), [])
+        self.assertTrue(stream.ignored)
+        self.assertIsNone(stream.codec)
+
+        stream = pcap.TcpStream()
+        self.assertEqual(len(stream.feed(100, 0, BINDING_SUCCESS[:30])), 0)
+        self.assertEqual(len(stream.feed(130, 0, BINDING_SUCCESS[30:])), 1)
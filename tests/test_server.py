@@ -0,0 +1,217 @@
+import asyncio
+import unittest
+
+import aiostun
+from aiostun import constants
+from aiostun import ratelimit
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_prefix(self):
+        """sources are grouped by /24 and /56"""
+        limiter = aiostun.RateLimiter()
+        self.assertEqual(limiter.prefix("192.0.2.1"), limiter.prefix("192.0.2.254"))
+        self.assertNotEqual(limiter.prefix("192.0.2.1"), limiter.prefix("192.0.3.1"))
+        self.assertEqual(limiter.prefix("2001:db8:0:ff::1"), limiter.prefix("2001:db8:0:80::2"))
+        self.assertNotEqual(limiter.prefix("2001:db8:0:ff::1"), limiter.prefix("2001:db8:0:100::1"))
+
+    def test_ipv4_mapped(self):
+        """ipv4-mapped sources of a dual-stack socket are grouped by /24 too"""
+        limiter = aiostun.RateLimiter(burst=1)
+        self.assertEqual(limiter.prefix("::ffff:192.0.2.1"), limiter.prefix("192.0.2.7"))
+        self.assertEqual(limiter.check("::ffff:192.0.2.1", now=1.0), ratelimit.ALLOW)
+        self.assertEqual(limiter.check("::ffff:198.51.100.7", now=1.0), ratelimit.ALLOW)
+        self.assertEqual(limiter.check("::FFFF:192.0.2.9", now=1.0), ratelimit.DROP)
+
+    def test_token_bucket(self):
+        """burst allowed, then rate limited with slips, refilled over time"""
+        limiter = aiostun.RateLimiter(rate=10, burst=5, slip=2)
+        verdicts = [ limiter.check("192.0.2.%s" % i, now=100.0) for i in range(9) ]
+        self.assertEqual(verdicts, [ratelimit.ALLOW] * 5 + [ratelimit.DROP, ratelimit.SLIP] * 2)
+        self.assertEqual((limiter.allowed, limiter.dropped, limiter.slipped), (5, 2, 2))
+
+        self.assertEqual(limiter.check("192.0.2.1", now=100.2), ratelimit.ALLOW)
+        self.assertEqual(limiter.check("198.51.100.1", now=100.2), ratelimit.ALLOW)
+
+    def test_constant_memory(self):
+        """the table does not grow with the number of sources"""
+        limiter = aiostun.RateLimiter(size=1000)
+        for i in range(5000):
+            limiter.check("10.%s.%s.1" % (i // 256, i % 256), now=0.0)
+        self.assertEqual(limiter.size, 1024)
+        self.assertEqual(len(limiter._tokens), 1024)
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+    async def test_binding(self):
+        """answer binding requests of the client"""
+        async with aiostun.Server(host="127.0.0.1", port=0, software="aiostun") as server:
+            (host, port) = server.get_local_addr()
+            async with aiostun.Client(host=host, port=port) as stunc:
+                mapped_addr = await stunc.get_mapped_address()
+                classic_addr = await stunc.get_mapped_address(use_classicstun=True)
+                local_addr = stunc.get_local_addr()
+
+        self.assertEqual((mapped_addr["ip"], mapped_addr["port"]), local_addr)
+        self.assertEqual((classic_addr["ip"], classic_addr["port"]), local_addr)
+
+    def test_rate_limited(self):
+        """dropped and slipped responses, garbage ignored"""
+        registry = aiostun.Registry()
+        server = aiostun.Server(rate_limiter=aiostun.RateLimiter(burst=1, slip=2, metrics=registry))
+        codec = aiostun.Codec()
+        req = codec.encode(aiostun.Message(aiostun.CLASS_REQUEST, aiostun.METHOD_BINDING, []))
+
+        self.assertIsNone(server.handle(b"\xff" * 20, ("192.0.2.1", 1000)))
+        self.assertIsNotNone(server.handle(req, ("192.0.2.1", 1000)))
+        self.assertIsNone(server.handle(req, ("192.0.2.2", 1000)))
+
+        codec.buf = server.handle(req, ("192.0.2.3", 1000))
+        resp = codec.decode()
+        self.assertEqual(resp.msgclass, constants.CLASS_ERROR)
+        self.assertEqual(resp.get_attribute(aiostun.attribute.AttrErrorCode).params["code"], 508)
+        self.assertEqual(registry.get(aiostun.metrics.RRL_DROPPED), 1)
+        self.assertEqual(registry.get(aiostun.metrics.RRL_SLIPPED), 1)
+
+    def test_ipv4_mapped_response(self):
+        """an ipv4 client of a dual-stack socket gets an ipv4 mapped address"""
+        server = aiostun.Server(host="::", family=constants.FAMILY_IP6)
+        codec = aiostun.Codec()
+        for msg in [ aiostun.Message(aiostun.CLASS_REQUEST, aiostun.METHOD_BINDING, []),
+                     aiostun.stun.ClassicMessage(aiostun.CLASS_REQUEST, aiostun.METHOD_BINDING, []) ]:
+            codec.buf = server.handle(codec.encode(msg), ("::ffff:192.0.2.1", 1000, 0, 0))
+            attr = codec.decode().attributes[0]
+            self.assertEqual((attr.params["family"], attr.params["ip"], attr.params["port"]),
+                             ("IPv4", "192.0.2.1", 1000))
+
+    def test_shed_load(self):
+        """300 try alternate to the least loaded peer above max_rate"""
+        registry = aiostun.Registry()
+        server = aiostun.Server(max_rate=2, metrics=registry,
+                                alternates=[("198.51.100.1", 3478), ("198.51.100.2", 3478), ("2001:db8::1", 3478)])
+        server.set_peer_load("198.51.100.1", 3478, 1.5)
+        codec = aiostun.Codec()
+        req = codec.encode(aiostun.Message(aiostun.CLASS_REQUEST, aiostun.METHOD_BINDING, []))
+
+        for _ in range(2):
+            codec.buf = server.handle(req, ("192.0.2.1", 1000))
+            self.assertEqual(codec.decode().msgclass, constants.CLASS_SUCCESS)
+
+        codec.buf = server.handle(req, ("192.0.2.1", 1000))
+        resp = codec.decode()
+        self.assertEqual(resp.msgclass, constants.CLASS_ERROR)
+        self.assertEqual(resp.get_attribute(aiostun.attribute.AttrErrorCode).params["code"], 300)
+        alternate = resp.get_attribute(aiostun.attribute.AttrAlternateServer)
+        self.assertEqual((alternate.params["ip"], alternate.params["port"]), ("198.51.100.2", 3478))
+        self.assertEqual(registry.get(aiostun.metrics.REDIRECTS_SENT), 1)
+
+        # all peers busier, the request is served
+        server.set_peer_load("198.51.100.2", 3478, 10)
+        server.set_peer_load("198.51.100.1", 3478, 10)
+        codec.buf = server.handle(req, ("192.0.2.1", 1000))
+        self.assertEqual(codec.decode().msgclass, constants.CLASS_SUCCESS)
+
+    async def test_follow_alternate(self):
+        """the client follows the redirect, without looping"""
+        registry = aiostun.Registry()
+        async with aiostun.Server(host="127.0.0.1", port=0) as peer:
+            (host, peer_port) = peer.get_local_addr()
+            async with aiostun.Server(host=host, port=0, max_rate=0, alternates=[(host, peer_port)]) as busy:
+                busy_port = busy.get_local_addr()[1]
+                async with aiostun.Client(host=host, port=busy_port, metrics=registry) as stunc:
+                    mapped_addr = await stunc.get_mapped_address()
+                    self.assertEqual(mapped_addr["port"], stunc.get_local_addr()[1])
+                    self.assertEqual(stunc._server_addr(), (host, peer_port))
+
+                # both servers busy and pointing at each other
+                peer._max_rate = 0
+                peer.set_peer_load(host, busy_port, 0)
+                async with aiostun.Client(host=host, port=busy_port) as stunc:
+                    resp = await stunc.bind_request()
+                    self.assertEqual(resp.get_attribute(aiostun.attribute.AttrErrorCode).params["code"], 300)
+
+        self.assertEqual(registry.get(aiostun.metrics.REDIRECTS_FOLLOWED), 1)
+        self.assertEqual(busy.redirected, 2)
+        self.assertEqual(peer.redirected, 1)
+
+    async def test_redirect_keeps_streams(self):
+        """following a redirect does not end the streams nor move the local port"""
+        class AppProtocol:
+            def __init__(self):
+                self.transports = []
+                self.lost = 0
+            def connection_made(self, transport):
+                self.transports.append(transport)
+            def datagram_received(self, data, addr):
+                pass
+            def connection_lost(self, exc):
+                self.lost += 1
+
+        async with aiostun.Server(host="127.0.0.1", port=0) as peer:
+            (host, peer_port) = peer.get_local_addr()
+            async with aiostun.Server(host=host, port=0, max_rate=0, alternates=[(host, peer_port)]) as busy:
+                stunc = await aiostun.Client(host=host, port=busy.get_local_addr()[1], demux=True).connect()
+                app = AppProtocol()
+                stunc.register_protocol(aiostun.demux.PACKET_DTLS, app)
+                local_addr = stunc.get_local_addr()
+
+                async def stream():
+                    return [ msg async for msg in stunc.messages() ]
+                task = asyncio.ensure_future(stream())
+                await asyncio.sleep(0)
+
+                mapped_addr = await stunc.get_mapped_address()
+                await asyncio.sleep(0.05)
+                self.assertEqual((mapped_addr["ip"], mapped_addr["port"]), local_addr)
+                self.assertEqual(stunc.get_local_addr(), local_addr)
+                self.assertEqual(stunc._server_addr(), (host, peer_port))
+                self.assertFalse(task.done())
+                self.assertIsNotNone(stunc._stun_codec._on_message)
+                self.assertEqual((len(app.transports), app.lost), (2, 0))
+
+                stunc.close()
+                self.assertEqual(await asyncio.wait_for(task, 1), [])
+                self.assertEqual(app.lost, 1)
+
+    async def test_redirect_unreachable(self):
+        """the client stays on the previous server when the alternate one can not be reached"""
+        async with aiostun.Server(host="127.0.0.1", port=0) as peer:
+            (host, peer_port) = peer.get_local_addr()
+            async with aiostun.Server(host=host, port=0, max_rate=0, alternates=[(host, peer_port)]) as busy:
+                busy_port = busy.get_local_addr()[1]
+                async with aiostun.Client(host=host, port=busy_port) as stunc:
+                    local_addr = stunc.get_local_addr()
+                    connect = stunc.connect
+                    async def unreachable(remote_addr=True):
+                        if stunc._port == peer_port:
+                            raise RuntimeError("Timeout error")
+                        return await connect(remote_addr)
+                    stunc.connect = unreachable
+
+                    with self.assertRaises(RuntimeError):
+                        await stunc.bind_request()
+                    self.assertEqual(stunc._server_addr(), (host, busy_port))
+                    self.assertEqual(stunc.get_local_addr(), local_addr)
+                    self.assertFalse(stunc._transport.is_closing())
+
+                    # still answered by the previous server
+                    busy._max_rate = None
+                    mapped_addr = await stunc.get_mapped_address()
+                    self.assertEqual(mapped_addr["port"], local_addr[1])
+                self.assertEqual(busy.redirected, 1)
+
+    async def test_redirect_tls(self):
+        """redirects are not followed over tls"""
+        stunc = aiostun.Client(host="127.0.0.1", proto=constants.IPPROTO_TLS)
+        redirect = aiostun.Message(constants.CLASS_ERROR, aiostun.METHOD_BINDING,
+                                   [aiostun.attribute.AttrErrorCode(), aiostun.attribute.AttrAlternateServer()])
+        redirect.attributes[0].params["code"] = 300
+        redirect.attributes[1].params.update({"ip": "192.0.2.2", "port": 3478})
+        async def bind_once(*args):
+            return redirect
+        stunc._bind_once = bind_once
+        async def reconnect(alternate):
+            self.fail("redirect followed over tls")
+        stunc._reconnect = reconnect
+
+        self.assertIs(await stunc.bind_request(), redirect)
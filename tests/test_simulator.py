@@ -0,0 +1,59 @@
+import asyncio
+import unittest
+
+import aiostun
+from aiostun import nat
+from aiostun import simulator
+
+
+class TestSimulator(unittest.TestCase):
+    async def discover(self, nat_type):
+        network = simulator.Network(latency=0.02, jitter=0.005)
+        server = await simulator.ClassicServer(network, "198.51.100.1", "198.51.100.2").start()
+        if nat_type is None:
+            host = network.host("203.0.113.10")
+        else:
+            host = network.host("10.0.0.2", network.add_nat("203.0.113.1", nat_type))
+        result = await aiostun.NAT(network=host).classic_discover(stun_host="198.51.100.1", stun_port=3478)
+        server.close()
+        return result
+
+    def test_nat_types(self):
+        """classic discovery finds the type of the simulated nat"""
+        expected = { None: nat.OPEN_INTERNET,
+                     simulator.NAT_FULL_CONE: nat.FULL_CONE,
+                     simulator.NAT_RESTRICTED: nat.RESTRICTED_NAT,
+                     simulator.NAT_PORT_RESTRICTED: nat.RESTRICTED_PORT_NAT,
+                     simulator.NAT_SYMMETRIC: nat.SYMMETRIC_NAT }
+        for nat_type, behavior in expected.items():
+            result = simulator.run(self.discover(nat_type))
+            self.assertEqual(result["nat"], behavior, nat_type)
+
+    async def bind_requests(self, count):
+        network = simulator.Network(latency=0.05, jitter=0.04, loss=0.2, reorder=0.1, seed=7)
+        server = await aiostun.Server(host="198.51.100.1", network=network.host("198.51.100.1")).start()
+        registry = aiostun.Registry()
+        async with aiostun.Client(host="198.51.100.1", retransmissions=3, rto=0.2, metrics=registry,
+                                  network=network.host("10.0.0.2", network.add_nat("203.0.113.1"))) as stunc:
+            answered = 0
+            for _ in range(count):
+                if await stunc.get_mapped_address():
+                    answered += 1
+        server.close()
+        return answered, registry.get(aiostun.metrics.RETRANSMITS), asyncio.get_running_loop().time()
+
+    def test_deterministic(self):
+        """same seed, same losses, retransmissions and virtual time"""
+        first = simulator.run(self.bind_requests(200))
+        self.assertEqual(simulator.run(self.bind_requests(200)), first)
+        (answered, retransmits, elapsed) = first
+        self.assertGreater(answered, 180)
+        self.assertGreater(retransmits, 0)
+        self.assertGreater(elapsed, 20)
+
+    def test_deadlock(self):
+        """waiting for nothing fails instead of hanging"""
+        async def wait():
+            await asyncio.get_running_loop().create_future()
+        with self.assertRaises(RuntimeError):
+            simulator.run(wait())
@@ -0,0 +1,78 @@
+import time
+import asyncio
+import unittest
+import concurrent.futures
+
+import aiostun
+from aiostun import sync
+from tests.server import StunResponder
+
+
+class TestSyncClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = sync.run(aiostun.Server(host="127.0.0.1", port=0).start())
+        (cls.host, cls.port) = cls.server.get_local_addr()
+
+    @classmethod
+    def tearDownClass(cls):
+        sync.get_loop().call_soon_threadsafe(cls.server.close)
+
+    def test_get_mapped_address(self):
+        """blocking calls reuse the same socket"""
+        with aiostun.SyncClient(host=self.host, port=self.port) as stunc:
+            first = stunc.get_mapped_address()
+            second = stunc.get_mapped_address()
+
+        self.assertEqual(first["ip"], "127.0.0.1")
+        self.assertEqual(first, second)
+
+    def test_thread_pool(self):
+        """many threads share a pool of clients"""
+        with aiostun.SyncClient(host=self.host, port=self.port, pool_size=4) as stunc:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+                results = list(pool.map(lambda _: stunc.get_mapped_address(), range(200)))
+            clients = len(stunc._clients)
+
+        self.assertTrue(all(r.get("ip") == "127.0.0.1" for r in results))
+        self.assertEqual(len(set(r["port"] for r in results)), clients)
+        self.assertLessEqual(clients, 4)
+
+    def test_blocking_call_from_loop(self):
+        """a blocking call from the loop thread would deadlock"""
+        async def noop():
+            pass
+
+        async def nested():
+            sync.run(noop())
+
+        with self.assertRaises(RuntimeError):
+            sync.run(nested())
+
+    def test_close_in_flight(self):
+        """closing the pool while a call waits for its response"""
+        async def responder():
+            loop = asyncio.get_running_loop()
+            return await loop.create_datagram_endpoint(lambda: StunResponder(drop=1), local_addr=("127.0.0.1", 0))
+        (transport, _) = sync.run(responder())
+        port = transport.get_extra_info("sockname")[1]
+
+        stunc = aiostun.SyncClient(host="127.0.0.1", port=port, timeout=0.2)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            call = pool.submit(stunc.get_mapped_address)
+            time.sleep(0.05)
+            stunc.close()
+            self.assertEqual(call.result(), {})
+        sync.get_loop().call_soon_threadsafe(transport.close)
+
+        with self.assertRaises(RuntimeError):
+            stunc.get_mapped_address()
+
+    def test_shutdown_from_loop(self):
+        """shutdown from the loop thread would wait for itself"""
+        async def stop():
+            sync.shutdown()
+
+        with self.assertRaises(RuntimeError):
+            sync.run(stop())
+        self.assertTrue(sync.get_loop().is_running())
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+
+import aiostun
+from aiostun import tracing
+from tests.server import StunResponder
+
+
+class TestTracing(unittest.IsolatedAsyncioTestCase):
+    async def test_transaction_span(self):
+        """follow a transaction with a retransmission"""
+        loop = asyncio.get_running_loop()
+        server, _ = await loop.create_datagram_endpoint(lambda: StunResponder(drop=1), local_addr=("127.0.0.1", 0))
+        port = server.get_extra_info("sockname")[1]
+
+        spans = []
+        tracer = tracing.SpanTracer(on_span=spans.append)
+        async with aiostun.Client(host="127.0.0.1", port=port, retransmissions=2, rto=0.05, tracer=tracer) as stunc:
+            await stunc.get_mapped_address()
+        server.close()
+
+        self.assertEqual(len(spans), 1)
+        events = [ event for event, _ in spans[0].events ]
+        self.assertEqual(events, [tracing.EVENT_SEND, tracing.EVENT_RETRANSMIT, tracing.EVENT_SEND,
+                                  tracing.EVENT_FIRST_BYTE, tracing.EVENT_DECODED, tracing.EVENT_MATCHED])
+        self.assertEqual(spans[0].status, tracing.EVENT_MATCHED)
+        self.assertGreater(spans[0].duration(), 0)
+
+    async def test_timeout(self):
+        """raw hook called on timeout"""
+        loop = asyncio.get_running_loop()
+        server, _ = await loop.create_datagram_endpoint(lambda: StunResponder(drop=10), local_addr=("127.0.0.1", 0))
+        port = server.get_extra_info("sockname")[1]
+
+        events = []
+        async with aiostun.Client(host="127.0.0.1", port=port, timeout=0.05,
+                                  tracer=lambda e, tid, ts: events.append((e, tid))) as stunc:
+            resp = await stunc.bind_request()
+        server.close()
+
+        self.assertIsNone(resp)
+        self.assertEqual([e for e, _ in events], [tracing.EVENT_SEND, tracing.EVENT_TIMEOUT])
+        self.assertEqual(events[0][1], events[1][1])
+
+    async def test_wait_for_resp(self):
+        """spans of the requests sent with send_request are closed by wait_for_resp"""
+        loop = asyncio.get_running_loop()
+        server, _ = await loop.create_datagram_endpoint(lambda: StunResponder(drop=1), local_addr=("127.0.0.1", 0))
+        port = server.get_extra_info("sockname")[1]
+
+        spans = []
+        tracer = tracing.SpanTracer(on_span=spans.append)
+        async with aiostun.Client(host="127.0.0.1", port=port, timeout=0.05, tracer=tracer) as stunc:
+            for _ in range(2):
+                stunc.send_request(aiostun.Message(aiostun.CLASS_REQUEST, aiostun.METHOD_BINDING, []))
+                await stunc.wait_for_resp()
+        server.close()
+
+        self.assertEqual([span.status for span in spans], [tracing.EVENT_TIMEOUT, tracing.EVENT_MATCHED])
+        self.assertEqual(tracer.spans, {})
+
+    def test_garbage_first(self):
+        """first_byte is sent with the transaction id, never for a rejected datagram"""
+        events = []
+        codec = aiostun.Codec(tracer=lambda e, tid, ts: events.append((e, tid)))
+        codec.feed_datagram(b"\x00\x01garbage")
+        codec.feed_datagram(bytes.fromhex("01010ff0" + "2112a442") + b"a"*12)
+        self.assertEqual(events, [])
+
+        resp = aiostun.Message(aiostun.constants.CLASS_SUCCESS, aiostun.METHOD_BINDING, [])
+        codec.feed_datagram(codec.encode(resp))
+        self.assertEqual(events, [(tracing.EVENT_FIRST_BYTE, resp.transaction_id),
+                                  (tracing.EVENT_DECODED, resp.transaction_id)])